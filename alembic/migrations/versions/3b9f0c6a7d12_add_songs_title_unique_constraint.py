@@ -0,0 +1,36 @@
+"""add songs title unique constraint
+
+Revision ID: 3b9f0c6a7d12
+Revises: 8c3d5e21f4a7
+Create Date: 2026-10-17 11:02:17.604913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3b9f0c6a7d12'
+down_revision = '8c3d5e21f4a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # concurrent crawlers could insert the same title twice, keep the oldest song and point everything at it
+    op.execute("""
+        CREATE TEMPORARY TABLE songs_duplicates AS
+        SELECT id, min(id) OVER (PARTITION BY title) AS original_id FROM songs
+    """)
+    op.execute("DELETE FROM songs_duplicates WHERE id = original_id")
+    op.execute("UPDATE history SET song_id = d.original_id FROM songs_duplicates d WHERE history.song_id = d.id")
+    op.execute("UPDATE bookmarks SET song_id = d.original_id FROM songs_duplicates d WHERE bookmarks.song_id = d.id")
+    op.execute("DELETE FROM songs USING songs_duplicates d WHERE songs.id = d.id")
+    op.execute("DROP TABLE songs_duplicates")
+
+    op.create_unique_constraint('uq_songs_title', 'songs', ['title'])
+    op.drop_index('ix_songs_title', table_name='songs')
+
+
+def downgrade():
+    op.create_index('ix_songs_title', 'songs', ['title'], unique=False, postgresql_using='hash')
+    op.drop_constraint('uq_songs_title', 'songs', type_='unique')
@@ -0,0 +1,23 @@
+"""add bookmarks user_id song_id index
+
+Revision ID: 5d2e8a4b9c61
+Revises: 3b9f0c6a7d12
+Create Date: 2026-10-17 13:05:22.604918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8a4b9c61'
+down_revision = '3b9f0c6a7d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bookmarks_user_id_song_id', 'bookmarks', ['user_id', 'song_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bookmarks_user_id_song_id', table_name='bookmarks')
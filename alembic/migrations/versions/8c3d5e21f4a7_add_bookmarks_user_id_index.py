@@ -0,0 +1,23 @@
+"""add bookmarks user_id index
+
+Revision ID: 8c3d5e21f4a7
+Revises: 1f74339f95ba
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8c3d5e21f4a7'
+down_revision = '1f74339f95ba'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_bookmarks_user_id_id', 'bookmarks', ['user_id', sa.text('id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bookmarks_user_id_id', table_name='bookmarks')
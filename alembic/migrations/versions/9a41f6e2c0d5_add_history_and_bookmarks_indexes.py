@@ -0,0 +1,29 @@
+"""add history and bookmarks indexes
+
+Revision ID: 9a41f6e2c0d5
+Revises: e47a1c9d3b28
+Create Date: 2026-10-17 14:31:56.830147
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9a41f6e2c0d5'
+down_revision = 'e47a1c9d3b28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # channel pages and the latest song per channel walk this index backwards
+    op.create_index('ix_history_channel_id_id', 'history', ['channel_id', sa.text('id DESC')], unique=False)
+    # most played songs and the RESTRICT checks of song deletes and title merges
+    op.create_index('ix_history_song_id', 'history', ['song_id'], unique=False)
+    op.create_index('ix_bookmarks_song_id', 'bookmarks', ['song_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_bookmarks_song_id', table_name='bookmarks')
+    op.drop_index('ix_history_song_id', table_name='history')
+    op.drop_index('ix_history_channel_id_id', table_name='history')
@@ -0,0 +1,116 @@
+"""partition history by month
+
+Revision ID: c6f2d8b05e93
+Revises: 9a41f6e2c0d5
+Create Date: 2026-10-17 15:20:44.917362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c6f2d8b05e93'
+down_revision = '9a41f6e2c0d5'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+
+def upgrade():
+    op.execute("ALTER TABLE history RENAME TO history_unpartitioned")
+    op.execute("ALTER INDEX history_pkey RENAME TO history_unpartitioned_pkey")
+    op.execute("ALTER INDEX ix_history_channel_id_id RENAME TO ix_history_unpartitioned_channel_id_id")
+    op.execute("ALTER INDEX ix_history_song_id RENAME TO ix_history_unpartitioned_song_id")
+
+    # the partition key has to be part of the primary key
+    op.execute("""
+        CREATE TABLE history (
+            id integer NOT NULL DEFAULT nextval('history_id_seq'::regclass),
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            song_id integer NOT NULL REFERENCES songs (id) ON DELETE RESTRICT,
+            channel_id integer NOT NULL REFERENCES channels (id) ON DELETE RESTRICT,
+            CONSTRAINT history_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE history_id_seq OWNED BY history.id")
+    # catches rows of a month whose partition was not created in time, see create_history_partition
+    op.execute("CREATE TABLE history_default PARTITION OF history DEFAULT")
+
+    op.execute("""
+        CREATE FUNCTION create_history_partition(month date) RETURNS void AS $$
+        DECLARE
+            partition_from date := date_trunc('month', month);
+            partition_to date := date_trunc('month', month) + interval '1 month';
+            partition_name text := 'history_' || to_char(month, '"y"YYYY"m"MM');
+        BEGIN
+            IF to_regclass(partition_name) IS NOT NULL THEN
+                RETURN;
+            END IF;
+
+            -- move the rows the default partition took in the meantime, attaching would fail otherwise
+            EXECUTE format('CREATE TABLE %I (LIKE history INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format('INSERT INTO %I SELECT * FROM history_default WHERE created_at >= %L AND created_at < %L',
+                           partition_name, partition_from, partition_to);
+            EXECUTE format('DELETE FROM history_default WHERE created_at >= %L AND created_at < %L',
+                           partition_from, partition_to);
+            EXECUTE format('ALTER TABLE history ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, partition_from, partition_to);
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE FUNCTION create_history_partitions(months_ahead integer) RETURNS void AS $$
+        BEGIN
+            -- crawlers may run this concurrently
+            PERFORM pg_advisory_xact_lock(hashtext('create_history_partitions'));
+
+            FOR i IN 0..months_ahead LOOP
+                PERFORM create_history_partition((date_trunc('month', now()) + i * interval '1 month')::date);
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+    op.execute("""
+        SELECT create_history_partition(month::date)
+        FROM generate_series(date_trunc('month', (SELECT min(created_at) FROM history_unpartitioned)),
+                             date_trunc('month', now()),
+                             interval '1 month') AS month
+    """)
+    op.execute(f"SELECT create_history_partitions({MONTHS_AHEAD})")
+    op.execute("INSERT INTO history (id, created_at, song_id, channel_id) "
+               "SELECT id, created_at, song_id, channel_id FROM history_unpartitioned")
+    op.execute("DROP TABLE history_unpartitioned")
+
+    # indexes on the partitioned table are created on every partition, present and future
+    op.create_index('ix_history_channel_id_id', 'history', ['channel_id', sa.text('id DESC')], unique=False)
+    op.create_index('ix_history_song_id', 'history', ['song_id'], unique=False)
+    op.execute("ANALYZE history")
+
+
+def downgrade():
+    op.execute("ALTER TABLE history RENAME TO history_partitioned")
+    op.execute("ALTER INDEX history_pkey RENAME TO history_partitioned_pkey")
+    op.execute("ALTER INDEX ix_history_channel_id_id RENAME TO ix_history_partitioned_channel_id_id")
+    op.execute("ALTER INDEX ix_history_song_id RENAME TO ix_history_partitioned_song_id")
+
+    op.create_table('history',
+                    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('history_id_seq'::regclass)"),
+                              nullable=False),
+                    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+                    sa.Column('song_id', sa.Integer(), nullable=False),
+                    sa.Column('channel_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['channel_id'], ['channels.id'], ondelete='RESTRICT'),
+                    sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ondelete='RESTRICT'),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.execute("ALTER SEQUENCE history_id_seq OWNED BY history.id")
+    op.execute("INSERT INTO history (id, created_at, song_id, channel_id) "
+               "SELECT id, created_at, song_id, channel_id FROM history_partitioned")
+    op.execute("DROP TABLE history_partitioned")
+    op.execute("DROP FUNCTION create_history_partitions(integer)")
+    op.execute("DROP FUNCTION create_history_partition(date)")
+
+    op.create_index('ix_history_channel_id_id', 'history', ['channel_id', sa.text('id DESC')], unique=False)
+    op.create_index('ix_history_song_id', 'history', ['song_id'], unique=False)
@@ -0,0 +1,32 @@
+"""add bookmarks user_id song_id unique constraint
+
+Revision ID: e47a1c9d3b28
+Revises: 5d2e8a4b9c61
+Create Date: 2026-10-17 13:48:09.271536
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e47a1c9d3b28'
+down_revision = '5d2e8a4b9c61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # racing requests and merged song titles could bookmark the same song twice, keep the oldest bookmark
+    op.execute("""
+        DELETE FROM bookmarks b
+        USING bookmarks o
+        WHERE b.user_id = o.user_id AND b.song_id = o.song_id AND b.id > o.id
+    """)
+
+    op.create_unique_constraint('uq_bookmarks_user_id_song_id', 'bookmarks', ['user_id', 'song_id'])
+    op.drop_index('ix_bookmarks_user_id_song_id', table_name='bookmarks')
+
+
+def downgrade():
+    op.create_index('ix_bookmarks_user_id_song_id', 'bookmarks', ['user_id', 'song_id'], unique=False)
+    op.drop_constraint('uq_bookmarks_user_id_song_id', 'bookmarks', type_='unique')
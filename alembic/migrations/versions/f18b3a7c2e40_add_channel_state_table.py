@@ -0,0 +1,59 @@
+"""add channel state table
+
+Revision ID: f18b3a7c2e40
+Revises: c6f2d8b05e93
+Create Date: 2026-10-17 16:08:31.552071
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f18b3a7c2e40'
+down_revision = 'c6f2d8b05e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('channel_state',
+                    sa.Column('channel_id', sa.Integer(), nullable=False),
+                    sa.Column('history_id', sa.Integer(), nullable=False),
+                    sa.Column('song_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['channel_id'], ['channels.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ondelete='RESTRICT'),
+                    sa.PrimaryKeyConstraint('channel_id')
+                    )
+
+    # runs in the inserting transaction, the state commits or rolls back with the history row
+    op.execute("""
+        CREATE FUNCTION update_channel_state() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO channel_state (channel_id, history_id, song_id)
+            VALUES (NEW.channel_id, NEW.id, NEW.song_id)
+            ON CONFLICT (channel_id) DO UPDATE
+            SET history_id = excluded.history_id, song_id = excluded.song_id
+            WHERE channel_state.history_id < excluded.history_id;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER history_update_channel_state
+        AFTER INSERT ON history
+        FOR EACH ROW EXECUTE PROCEDURE update_channel_state()
+    """)
+
+    op.execute("""
+        INSERT INTO channel_state (channel_id, history_id, song_id)
+        SELECT DISTINCT ON (channel_id) channel_id, id, song_id
+        FROM history
+        ORDER BY channel_id, id DESC
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER history_update_channel_state ON history")
+    op.execute("DROP FUNCTION update_channel_state()")
+    op.drop_table('channel_state')
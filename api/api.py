@@ -6,6 +6,7 @@ import jinja2
 from aiohttp import web
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
+from api.cache import cache_channels, create_history_cache
 from api.cors import cors_middleware, set_cors
 from api.csrf import csrf_middleware
 from api.database import create_postgres_connection_pool, close_postgres_connection_pool
@@ -36,15 +37,22 @@ async def build() -> web.Application:
     app.router.add_get("/channels", get_channels_handler, name="channels")
     app.router.add_get("/history", get_history_handler, name="history")
     app.router.add_get("/history/events", get_history_events_handler, name="history_events")
+    app.router.add_get("/now_playing", get_now_playing_handler, name="now_playing")
     app.router.add_get("/user", get_user_handler, name="user")
     app.router.add_get("/user/sign_out", get_user_sign_out_handler, name="user_sign_out")
     app.router.add_get("/user/google", get_user_google_handler, name="user_google")
     app.router.add_get("/user/google/callback", get_user_google_callback_handler, name="user_google_callback")
     app.router.add_get("/user/bookmarks", get_user_bookmarks_handler, name="user_bookmarks")
     app.router.add_post("/user/bookmarks", post_user_bookmarks_handler, name="post_user_bookmarks")
+    app.router.add_post("/user/bookmarks/batch", post_user_bookmarks_batch_handler, name="post_user_bookmarks_batch")
+    app.router.add_delete("/user/bookmarks/batch", delete_user_bookmarks_batch_handler,
+                          name="delete_user_bookmarks_batch")
     app.router.add_delete("/user/bookmarks/{bookmark_id}", delete_user_bookmarks_handler, name="delete_user_bookmarks")
     app.router.add_get(openapi_route["url"], get_openapi_handler, name=openapi_route["name"])
 
+    if settings["metrics"]["enabled"]:
+        app.router.add_get("/metrics", get_metrics_handler, name="metrics")
+
     app.middlewares.append(aiohttp_session.session_middleware(cookie_storage))
     app.middlewares.append(cors_middleware)
     app.middlewares.append(csrf_middleware)
@@ -54,6 +62,8 @@ async def build() -> web.Application:
 
     app.on_startup.append(create_postgres_connection_pool)
     app.on_startup.append(create_redis_connection_pool)
+    app.on_startup.append(cache_channels)
+    app.on_startup.append(create_history_cache)
     app.on_startup.append(create_sse_redis_subscriber)
     app.on_startup.append(generate_openapi_spec)
 
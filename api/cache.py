@@ -0,0 +1,161 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Tuple
+
+from aiohttp import web
+
+from api import metrics
+from api.database import fetch_channels, fetch_history, fetch_song_bookmark_ids
+from api.etag import generate_body_etag
+from api.schemas import dumps
+from api.settings import settings
+
+
+class LRUCache:
+    """Bounded mapping which evicts the least recently used key once full"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.size <= 0:
+            return
+
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class HistoryCache:
+    """Anonymous base results of the offset-less /history pages, per channel and cursor
+
+    Cursor pages never change since history is append-only. First pages are updated in place
+    from the history events, and fetched again after `max_age` seconds in case an event was missed.
+    The cache is cleared whenever the history events stop, see api.sse.set_history_events_live.
+    """
+
+    def __init__(self, size: int, max_age: float) -> None:
+        self.pages = LRUCache(size)
+        self.max_age = max_age
+        self.versions = {}
+        self.generation = 0
+
+    @staticmethod
+    def is_cacheable(parameters: Dict) -> bool:
+        return not parameters["offset"]
+
+    @staticmethod
+    def key(parameters: Dict) -> Tuple[int, int]:
+        return parameters["channel_id"], parameters["before_id"]
+
+    def get(self, parameters: Dict) -> List[Dict]:
+        entry = self.pages.get(self.key(parameters))
+        page = None
+
+        if entry is not None:
+            fetched_at, page = entry
+
+            if parameters["before_id"] == 0 and time.monotonic() - fetched_at > self.max_age:
+                page = None
+
+        metrics.increment("history_cache_hits" if page is not None else "history_cache_misses")
+        return page
+
+    def version(self, channel_id: int) -> Tuple[int, int]:
+        return self.generation, self.versions.get(channel_id, 0)
+
+    def set(self, parameters: Dict, page: List[Dict], version: Tuple[int, int]) -> None:
+        # an event arrived or the cache was cleared while the page was fetched, the page may already be stale
+        if version != self.version(parameters["channel_id"]):
+            if parameters["before_id"] == 0 or version[0] != self.generation:
+                return
+
+        self.pages.set(self.key(parameters), (time.monotonic(), page))
+
+    def clear(self) -> None:
+        self.pages.clear()
+        self.generation += 1
+
+    def add_history_item(self, history_item: Dict) -> None:
+        limit = settings["pagination"]["limit"]
+        base_item = dict(history_item, bookmark_id=0)
+
+        for channel_id in (0, history_item["channel_id"]):
+            self.versions[channel_id] = self.versions.get(channel_id, 0) + 1
+            key = (channel_id, 0)
+            entry = self.pages.get(key)
+
+            if entry is None:
+                continue
+
+            fetched_at, page = entry
+
+            if page and page[0]["id"] >= history_item["id"]:
+                # out of order event, let the next request fetch the page again
+                self.pages.set(key, None)
+                continue
+
+            # the age is kept, the page is fetched again after max_age even when every event arrived
+            self.pages.set(key, (fetched_at, [base_item] + page[:limit - 1]))
+
+
+async def cache_channels(app: web.Application) -> None:
+    """Channels are only added by migrations, /channels is serialized once like the OpenAPI spec"""
+    app["channels_body"] = dumps(await fetch_channels(app["database"]))
+    app["channels_etag"] = generate_body_etag(app["channels_body"])
+
+
+async def create_history_cache(app: web.Application) -> None:
+    app["history_cache"] = HistoryCache(settings["cache"]["history"]["size"], settings["cache"]["history"]["max_age"])
+
+
+async def fetch_history_cached(app: web.Application, parameters: Dict, user_id: int = 0) -> List[Dict]:
+    """Serve the base page from the cache and overlay the bookmarks of the signed in user
+
+    The overlay is a single lookup of the user's bookmarks among the songs of the page.
+    """
+    database = app["database"]
+    history_cache = app["history_cache"]
+
+    # without history events the cached first pages would go stale
+    if not history_cache.is_cacheable(parameters) or not app["history_events_live"]:
+        return await fetch_history(database, parameters, user_id)
+
+    page = history_cache.get(parameters)
+
+    if page is None:
+        version = history_cache.version(parameters["channel_id"])
+        page = await fetch_history(database, parameters)
+        history_cache.set(parameters, page, version)
+
+    if user_id and page:
+        song_bookmark_ids = await fetch_song_bookmark_ids(database, user_id, [item["song_id"] for item in page])
+        page = [dict(item, bookmark_id=song_bookmark_ids.get(item["song_id"], 0)) for item in page]
+
+    return page
@@ -34,7 +34,7 @@ def generate_cors_headers() -> Dict:
             hdrs.ACCESS_CONTROL_ALLOW_CREDENTIALS: "true",
             hdrs.ACCESS_CONTROL_ALLOW_METHODS: ",".join(allowed_methods),
             hdrs.ACCESS_CONTROL_ALLOW_HEADERS: ",".join(allowed_headers),
-            hdrs.ACCESS_CONTROL_EXPOSE_HEADERS: ",".join([hdrs.CONTENT_LENGTH])
+            hdrs.ACCESS_CONTROL_EXPOSE_HEADERS: ",".join([hdrs.CONTENT_LENGTH, settings["pagination"]["cursor_header"]])
         }
 
     return headers
@@ -1,9 +1,15 @@
-from typing import List, Dict, Mapping
+import asyncio
+import functools
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, List, Dict, Hashable, Mapping
 
 from aiohttp import web
+from asyncpg import ForeignKeyViolationError
 from databases import Database
-from sqlalchemy import desc, select, CHAR
+from sqlalchemy import cast, desc, literal, select, text, true, CHAR, UniqueConstraint
+from sqlalchemy.dialects.postgresql import insert
 
+from api import metrics
 from api.schemas import *
 from api.settings import settings
 
@@ -13,20 +19,31 @@ from sqlalchemy import MetaData, Table, Column, Integer, String, Index, DateTime
 meta = MetaData()
 
 channels_table = Table("channels", meta,
-                       Column("id",  Integer, primary_key=True, nullable=False),
+                       Column("id",  Integer, primary_key=True, autoincrement=True, nullable=False),
                        Column("name", String(10), nullable=False),
                        Column("url", String(200), nullable=False))
 
 songs_table = Table("songs", meta,
                     Column("id",  Integer, primary_key=True, nullable=False),
-                    Column("title", String(200), index=Index(name="ix_songs_title", postgresql_using="hash"), nullable=False))
+                    Column("title", String(200), nullable=False),
+                    UniqueConstraint("title", name="uq_songs_title"))
 
+# partitioned by month, the partitions are created by the create_history_partitions function, see crawler.partitions
 history_table = Table("history", meta,
-                      Column("id",  Integer, primary_key=True, nullable=False),
-                      Column("created_at", DateTime, server_default=func.now(), nullable=False),
+                      Column("id",  Integer, primary_key=True, autoincrement=True, nullable=False),
+                      Column("created_at", DateTime, server_default=func.now(), primary_key=True, nullable=False),
                       Column("song_id", Integer, ForeignKey("songs.id", ondelete='RESTRICT'), nullable=False),
-                      Column("channel_id", Integer, ForeignKey("channels.id", ondelete='RESTRICT'), nullable=False))
-
+                      Column("channel_id", Integer, ForeignKey("channels.id", ondelete='RESTRICT'), nullable=False),
+                      Index("ix_history_channel_id_id", "channel_id", text("id DESC")),
+                      Index("ix_history_song_id", "song_id"),
+                      postgresql_partition_by="RANGE (created_at)")
+
+# latest history item per channel, kept by the history_update_channel_state trigger on every history insert
+channel_state_table = Table("channel_state", meta,
+                            Column("channel_id", Integer, ForeignKey("channels.id", ondelete='CASCADE'),
+                                   primary_key=True, nullable=False),
+                            Column("history_id", Integer, nullable=False),
+                            Column("song_id", Integer, ForeignKey("songs.id", ondelete='RESTRICT'), nullable=False))
 
 users_table = Table("users", meta,
                     Column("id",  Integer, primary_key=True, nullable=False),
@@ -36,10 +53,57 @@ users_table = Table("users", meta,
                     Column("family_name", String(50), nullable=False))
 
 bookmarks_table = Table("bookmarks", meta,
-                        Column("id",  Integer, primary_key=True, nullable=False),
+                        Column("id",  Integer, primary_key=True, autoincrement=True, nullable=False),
                         Column("created_at", DateTime, server_default=func.now(), nullable=False),
                         Column("user_id", Integer, ForeignKey("users.id", ondelete='RESTRICT'), nullable=False),
-                        Column("song_id", Integer, ForeignKey("songs.id", ondelete='RESTRICT'), nullable=False))
+                        Column("song_id", Integer, ForeignKey("songs.id", ondelete='RESTRICT'), nullable=False),
+                        Index("ix_bookmarks_user_id_id", "user_id", text("id DESC")),
+                        Index("ix_bookmarks_song_id", "song_id"),
+                        UniqueConstraint("user_id", "song_id", name="uq_bookmarks_user_id_song_id"))
+
+
+in_flight_reads = {}
+
+
+def freeze(value: Any) -> Hashable:
+    if isinstance(value, Mapping):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(item) for item in value)
+
+    return value
+
+
+def retrieve_exception(task: asyncio.Future) -> None:
+    # every caller may have been cancelled before the shared call failed, nobody else would retrieve its error
+    if not task.cancelled():
+        task.exception()
+
+
+def coalesce(function: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """Share one in flight call and its decoded result between concurrent identical reads
+
+    The result is shared by reference, callers must not mutate it. Cancelling one caller does not
+    cancel the call for the others.
+    """
+    @functools.wraps(function)
+    async def wrapper(database: Database, *args, **kwargs):
+        key = (function.__name__, id(database), freeze(args), freeze(kwargs))
+        task = in_flight_reads.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(function(database, *args, **kwargs))
+            in_flight_reads[key] = task
+            task.add_done_callback(lambda _: in_flight_reads.pop(key, None))
+            task.add_done_callback(retrieve_exception)
+            metrics.increment("database_reads")
+        else:
+            metrics.increment("database_coalesced_reads")
+
+        return await asyncio.shield(task)
+
+    return wrapper
 
 
 async def create_postgres_connection_pool(app: web.Application) -> None:
@@ -52,28 +116,36 @@ async def close_postgres_connection_pool(app: web.Application) -> None:
     await app["database"].disconnect()
 
 
+@coalesce
 async def fetch_channels(database: Database) -> List[Dict]:
-    channel_schema = ChannelSchema(many=True)
     query = channels_table.select()
     rows = await database.fetch_all(query)
-    data = channel_schema.dump(rows)
+    data = channel_dumper.dump_many(rows)
     return data
 
 
-async def fetch_channels_extra(database: Database) -> List[Dict]:
-    channel_extra_schema = ChannelExtraSchema(many=True)
-    subquery = select([history_table.c.channel_id, songs_table]) \
-        .distinct(history_table.c.channel_id) \
-        .select_from(history_table.outerjoin(songs_table)) \
-        .order_by(history_table.c.channel_id, desc(history_table.c.id)) \
-        .lateral("channels_last_songs")
-    query = select([channels_table,
-                    subquery.c.id.label("song_id"),
-                    subquery.c.title.label("song_title")]) \
-        .select_from(channels_table.outerjoin(subquery, channels_table.c.id == subquery.c.channel_id))
+def select_channels_extra():
+    return select([channels_table,
+                   channel_state_table.c.history_id,
+                   channel_state_table.c.song_id,
+                   songs_table.c.title.label("song_title")]) \
+        .select_from(channels_table
+                     .outerjoin(channel_state_table)
+                     .outerjoin(songs_table, songs_table.c.id == channel_state_table.c.song_id))
+
 
+async def fetch_channels_extra(database: Database) -> List[Dict]:
+    query = select_channels_extra()
     rows = await database.fetch_all(query)
-    data = channel_extra_schema.dump(rows)
+    data = channel_extra_dumper.dump_many(rows)
+    return data
+
+
+async def fetch_channel_extra(database: Database, channel_id: int) -> Dict:
+    channel_extra_schema = ChannelExtraSchema()
+    query = select_channels_extra().where(channels_table.c.id == channel_id)
+    row = await database.fetch_one(query)
+    data = channel_extra_schema.dump(row)
     return data
 
 
@@ -91,6 +163,27 @@ async def fetch_song_by_title(database: Database, title: str) -> Dict:
     return song_schema.dump(row)
 
 
+async def fetch_songs_most_played(database: Database, limit: int, history_limit: int) -> List[Dict]:
+    """Most played songs among the latest history items, the whole history is never aggregated"""
+    song_schema = SongSchema(many=True)
+    recent_history = select([history_table.c.song_id]) \
+        .order_by(desc(history_table.c.id)) \
+        .limit(history_limit) \
+        .alias("recent_history")
+    play_count = func.count().label("play_count")
+    most_played = select([recent_history.c.song_id, play_count]) \
+        .group_by(recent_history.c.song_id) \
+        .order_by(desc(play_count)) \
+        .limit(limit) \
+        .alias("most_played")
+    query = select([songs_table]) \
+        .select_from(most_played.join(songs_table, songs_table.c.id == most_played.c.song_id)) \
+        .order_by(desc(most_played.c.play_count))
+    rows = await database.fetch_all(query)
+    data = song_schema.dump(rows)
+    return data
+
+
 async def insert_song(database: Database, title: str) -> int:
     song_schema = SongSchema()
     query = songs_table.insert()
@@ -99,58 +192,129 @@ async def insert_song(database: Database, title: str) -> int:
     return song_id
 
 
+@coalesce
 async def fetch_history(database: Database, parameters: HistoryRequestQuerySchema.dump, user_id: int = 0) -> List[Dict]:
-    history_schema = HistorySchema(many=True)
-    query = select([history_table, songs_table.c.title.label('song_title')]) \
-        .select_from(history_table.outerjoin(songs_table)) \
-        .order_by(desc(history_table.c.id))\
-        .limit(settings["pagination"]["limit"])\
-        .offset(parameters["offset"])
+    columns = [history_table, songs_table.c.title.label('song_title')]
+    from_clause = history_table.outerjoin(songs_table)
 
-    if parameters["channel_id"]:
-        query = query.where(history_table.c.channel_id == parameters["channel_id"])
+    if user_id:
+        # the lateral lookup is served by the (user_id, song_id) index and never multiplies history rows
+        bookmarks_subquery = select([bookmarks_table.c.id]) \
+            .where(bookmarks_table.c.user_id == user_id) \
+            .where(bookmarks_table.c.song_id == history_table.c.song_id) \
+            .limit(1) \
+            .lateral("history_bookmarks")
+        columns.append(func.coalesce(bookmarks_subquery.c.id, 0).label("bookmark_id"))
+        from_clause = from_clause.outerjoin(bookmarks_subquery, true())
+
+    query = select(columns) \
+        .select_from(from_clause) \
+        .order_by(desc(history_table.c.id))\
+        .limit(settings["pagination"]["limit"])
 
-    history_rows = await database.fetch_all(query)
-    song_ids = []
+    # keyset pagination seeks directly on the primary key, offset pagination is kept for backward compatibility
+    if parameters["before_id"]:
+        query = query.where(history_table.c.id < parameters["before_id"])
 
-    if history_rows and user_id:
-        bookmark_schema = BookmarkSchema(many=True)
-        song_ids = [item["song_id"] for item in history_rows]
+        # cursors carry the created_at of their item, a constant bound prunes the newer partitions at planning.
+        # IDs and created_at grow together except for overlapping transactions, the day of slack covers those
+        if parameters.get("before_created_at"):
+            query = query.where(history_table.c.created_at < parameters["before_created_at"] + timedelta(days=1))
+    else:
+        query = query.offset(parameters["offset"])
 
-        bookmarks_query = select([bookmarks_table],
-                                 bookmarks_table.c.song_id.in_(song_ids))\
-            .where(bookmarks_table.c.user_id == user_id)
-        bookmarks_rows = await database.fetch_all(bookmarks_query)
-        bookmarks = bookmark_schema.dump(bookmarks_rows)
-        song_bookmarks = {bookmark["song_id"] : bookmark["id"] for bookmark in bookmarks}
+    if parameters["channel_id"]:
+        query = query.where(history_table.c.channel_id == parameters["channel_id"])
 
-        def mapper(item):
-            item = dict(item)
-            item["bookmark_id"] = song_bookmarks[item["song_id"]] if item["song_id"] in song_bookmarks else 0
-            return item
+    rows = await database.fetch_all(query)
+    data = history_dumper.dump_many(rows)
+    return data
 
-        history_rows = list(map(mapper, history_rows))
 
-    history = history_schema.dump(history_rows)
-    return history
+async def fetch_song_bookmark_ids(database: Database, user_id: int, song_ids: List[int]) -> Dict[int, int]:
+    query = select([bookmarks_table.c.song_id, bookmarks_table.c.id]) \
+        .where(bookmarks_table.c.user_id == user_id) \
+        .where(bookmarks_table.c.song_id.in_(song_ids))
+    rows = await database.fetch_all(query)
+    return {row["song_id"]: row["id"] for row in rows}
 
 
-async def fetch_history_item(database: Database, history_id: int) -> Dict:
+async def fetch_history_item(database: Database, history_id: int, created_at: datetime = None) -> Dict:
+    """The creation time, when known, limits the lookup to its partition instead of probing every partition"""
     history_schema = HistorySchema()
     query = select([history_table, songs_table.c.title.label('song_title')]) \
         .select_from(history_table.outerjoin(songs_table)) \
         .where(history_table.c.id == history_id)
+
+    if created_at is not None:
+        query = query.where(history_table.c.created_at == created_at)
     row = await database.fetch_one(query)
     data = history_schema.dump(row)
     return data
 
 
-async def insert_history_item(database: Database, channel_id: int, song_id: int) -> int:
-    history_schema = HistoryInputSchema()
-    query = history_table.insert()
-    values = history_schema.load({"channel_id": channel_id, "song_id": song_id})
-    history_id = await database.execute(query=query, values=values)
-    return history_id
+async def insert_history_item_by_song_title(database: Database, channel_id: int, song_title: str,
+                                            song_id: int = 0) -> Dict:
+    """Upsert the song and insert the history item, returning it with the song title
+
+    When the song ID is already known, e.g. from the crawler songs cache, the songs table is skipped entirely.
+    Otherwise both statements run in one transaction, each with a plain RETURNING clause.
+    """
+    if not song_id:
+        song_schema = SongSchema()
+        values = song_schema.load({"title": song_title})
+
+        # DO UPDATE instead of DO NOTHING, otherwise RETURNING skips the already existing song
+        song_insert = insert(songs_table).values(**values)
+        song_query = song_insert \
+            .on_conflict_do_update(constraint="uq_songs_title", set_={"title": song_insert.excluded.title}) \
+            .returning(songs_table.c.id)
+
+        async with database.transaction():
+            song_id = await database.fetch_val(song_query)
+            return await insert_history_item_by_song_title(database, channel_id, song_title, song_id)
+
+    query = history_table.insert() \
+        .values(channel_id=channel_id, song_id=song_id) \
+        .returning(*history_table.c)
+    row = await database.fetch_one(query)
+    data = history_dumper.dump(dict(row, song_title=song_title))
+    return data
+
+
+async def insert_history_items(database: Database, items: List[Dict]) -> List[Dict]:
+    """Insert many history items with multi-row statements, meant to run inside a transaction
+
+    Each item holds the channel_id, song_title and song_id (0 when unknown).
+    One history item is returned per given item, in no guaranteed order.
+    """
+    song_ids = {item["song_title"]: item["song_id"] for item in items if item["song_id"]}
+    new_song_titles = sorted({item["song_title"] for item in items if item["song_title"] not in song_ids})
+
+    if new_song_titles:
+        song_schema = SongSchema(many=True)
+        values = song_schema.load([{"title": song_title} for song_title in new_song_titles])
+        song_insert = insert(songs_table).values(values)
+        song_query = song_insert \
+            .on_conflict_do_update(constraint="uq_songs_title", set_={"title": song_insert.excluded.title}) \
+            .returning(songs_table.c.id, songs_table.c.title)
+        song_rows = await database.fetch_all(song_query)
+        song_ids.update({row["title"]: row["id"] for row in song_rows})
+
+    song_titles = {song_id: song_title for song_title, song_id in song_ids.items()}
+    history_query = history_table.insert() \
+        .values([{"channel_id": item["channel_id"], "song_id": song_ids[item["song_title"]]} for item in items]) \
+        .returning(*history_table.c)
+    history_rows = await database.fetch_all(history_query)
+    history_items = [dict(row, song_title=song_titles[row["song_id"]]) for row in history_rows]
+
+    data = history_dumper.dump_many(history_items)
+    return data
+
+
+async def create_history_partitions(database: Database, months_ahead: int) -> None:
+    query = select([func.create_history_partitions(months_ahead)])
+    await database.fetch_val(query)
 
 
 async def fetch_user(database: Database, user_id: int) -> Dict:
@@ -185,18 +349,21 @@ async def update_user(database: Database, given_name: str, family_name: str, pic
 
 
 async def fetch_bookmarks(database: Database, parameters: BookmarksRequestQuerySchema.dump, user_id: int = 0) -> List[Dict]:
-    bookmark_schema = BookmarkSchema(many=True)
     query = select([bookmarks_table, songs_table.c.title.label('song_title')]) \
         .select_from(bookmarks_table.outerjoin(songs_table)) \
         .order_by(desc(bookmarks_table.c.id))\
-        .limit(settings["pagination"]["limit"])\
-        .offset(parameters["offset"])
+        .limit(settings["pagination"]["limit"])
+
+    if parameters["before_id"]:
+        query = query.where(bookmarks_table.c.id < parameters["before_id"])
+    else:
+        query = query.offset(parameters["offset"])
 
     if user_id:
         query = query.where(bookmarks_table.c.user_id == user_id)
 
     rows = await database.fetch_all(query)
-    data = bookmark_schema.dump(rows)
+    data = bookmark_dumper.dump_many(rows)
     return data
 
 
@@ -229,6 +396,69 @@ async def insert_bookmark(database: Database, user_id: int, song_id: int) -> int
     return bookmark_id
 
 
+async def upsert_bookmark(database: Database, user_id: int, song_id: int) -> Dict:
+    """Insert the bookmark or get the existing one, then fetch the song title in the same transaction
+
+    An empty dict is returned when the song does not exist, the foreign key does the check.
+    """
+    bookmark_schema = BookmarkSchema()
+    values = bookmark_schema.load({"user_id": user_id, "song_id": song_id})
+
+    # DO UPDATE instead of DO NOTHING, otherwise RETURNING skips the already existing bookmark
+    bookmark_insert = insert(bookmarks_table).values(**values)
+    bookmark_query = bookmark_insert \
+        .on_conflict_do_update(constraint="uq_bookmarks_user_id_song_id",
+                               set_={"song_id": bookmark_insert.excluded.song_id}) \
+        .returning(*bookmarks_table.c)
+    song_query = select([songs_table.c.title]).where(songs_table.c.id == song_id)
+
+    try:
+        async with database.transaction():
+            row = await database.fetch_one(bookmark_query)
+            song_title = await database.fetch_val(song_query)
+    except ForeignKeyViolationError:
+        return {}
+
+    data = bookmark_dumper.dump(dict(row, song_title=song_title))
+    return data
+
+
+async def upsert_bookmarks(database: Database, user_id: int, song_ids: List[int]) -> List[Dict]:
+    """Insert the bookmarks or get the existing ones with one multi-row statement, then fetch their song titles
+
+    Only songs that exist are bookmarked, the others are left out of the result.
+    """
+    song_query = select([cast(literal(user_id), Integer), songs_table.c.id]) \
+        .where(songs_table.c.id.in_(song_ids))
+    bookmark_insert = insert(bookmarks_table).from_select(["user_id", "song_id"], song_query)
+    bookmark_query = bookmark_insert \
+        .on_conflict_do_update(constraint="uq_bookmarks_user_id_song_id",
+                               set_={"song_id": bookmark_insert.excluded.song_id}) \
+        .returning(*bookmarks_table.c)
+
+    async with database.transaction():
+        rows = await database.fetch_all(bookmark_query)
+
+        if not rows:
+            return []
+
+        title_query = select([songs_table.c.id, songs_table.c.title]) \
+            .where(songs_table.c.id.in_([row["song_id"] for row in rows]))
+        song_titles = {row["id"]: row["title"] for row in await database.fetch_all(title_query)}
+
+    data = bookmark_dumper.dump_many([dict(row, song_title=song_titles[row["song_id"]]) for row in rows])
+    return data
+
+
+async def delete_bookmarks(database: Database, user_id: int, bookmark_ids: List[int]) -> List[int]:
+    query = bookmarks_table.delete() \
+        .where(bookmarks_table.c.user_id == user_id) \
+        .where(bookmarks_table.c.id.in_(bookmark_ids)) \
+        .returning(bookmarks_table.c.id)
+    rows = await database.fetch_all(query)
+    return [row["id"] for row in rows]
+
+
 async def delete_bookmark(database: Database, bookmark_id: int) -> None:
     query = bookmarks_table.delete().where(bookmarks_table.c.id == bookmark_id)
     await database.execute(query=query)
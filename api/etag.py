@@ -0,0 +1,45 @@
+import hashlib
+from typing import Any
+
+from aiohttp import web, hdrs
+
+from api.schemas import dumps
+
+
+def generate_etag(*parts: Any) -> str:
+    return '"{}"'.format("-".join(str(part) for part in parts))
+
+
+def generate_body_etag(body: bytes) -> str:
+    return generate_etag(hashlib.md5(body).hexdigest())
+
+
+def is_not_modified(request: web.Request, etag: str) -> bool:
+    if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    # weak comparison, see https://tools.ietf.org/html/rfc7232#section-2.3.2
+    return etag in (tag.strip().replace("W/", "", 1) for tag in if_none_match.split(","))
+
+
+def not_modified_response(etag: str) -> web.Response:
+    return web.Response(status=304, headers={hdrs.ETAG: etag})
+
+
+def body_response_with_etag(request: web.Request, body: bytes, etag: str = None) -> web.Response:
+    """Reply 304 when the client already has the representation, the etag defaults to a hash of the body"""
+    etag = etag or generate_body_etag(body)
+
+    if is_not_modified(request, etag):
+        return not_modified_response(etag)
+
+    return web.Response(body=body, content_type="application/json", headers={hdrs.ETAG: etag})
+
+
+def json_response_with_etag(request: web.Request, data: Any, etag: str = None) -> web.Response:
+    return body_response_with_etag(request, dumps(data), etag)
@@ -0,0 +1,12 @@
+from collections import Counter
+from typing import Dict
+
+metrics = Counter()
+
+
+def increment(name: str, value: int = 1) -> None:
+    metrics[name] += value
+
+
+def snapshot() -> Dict:
+    return dict(metrics)
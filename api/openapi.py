@@ -1,3 +1,4 @@
+import json
 import re
 from typing import Dict, Iterable
 
@@ -9,6 +10,7 @@ from apispec import APISpec as APISpec
 from apispec.yaml_utils import load_operations_from_docstring
 
 from api import schemas as schemas_module
+from api.etag import body_response_with_etag, generate_body_etag
 from api.utils import issubclass_py37
 
 
@@ -77,10 +79,12 @@ async def generate_openapi_spec(app: web.Application) -> None:
         spec.path(path=path, operations=operations)
 
     app["openapi"] = spec
+    app["openapi_body"] = json.dumps(spec.to_dict()).encode("utf-8")
+    app["openapi_etag"] = generate_body_etag(app["openapi_body"])
 
 
 async def get_openapi_handler(request: Request) -> web.Response:
-    return web.json_response(request.app["openapi"].to_dict())
+    return body_response_with_etag(request, request.app["openapi_body"], request.app["openapi_etag"])
 
 
 def clean(text: str) -> str:
@@ -93,7 +97,7 @@ def lookup(key: str, data: Dict) -> Iterable[str]:
             if k == key:
                 if isinstance(v, str):
                     yield clean(v)
-                elif isinstance(v, dict) and "items" in v:
+                elif isinstance(v, dict) and isinstance(v.get("items"), str):
                     yield clean(v["items"])
             if isinstance(v, (dict, list)):
                 yield from lookup(key, v)
@@ -1,3 +1,6 @@
+import json
+from typing import Dict, List
+
 import aioredis
 from aiohttp import web
 
@@ -11,3 +14,18 @@ async def create_redis_connection_pool(app: web.Application) -> None:
 async def close_redis_connection_pool(app: web.Application) -> None:
     app['redis'].close()
     await app['redis'].wait_closed()
+
+
+async def publish_history_items(redis: aioredis.Redis, history_items: List[Dict]) -> None:
+    """Publish history items to subscribers and append them to the capped recent events stream, in one pipeline"""
+    redis_settings = settings["redis"]
+    pipeline = redis.pipeline()
+
+    for history_item in history_items:
+        message = json.dumps(history_item)
+        pipeline.publish(redis_settings["channel"], message)
+        pipeline.xadd(redis_settings["stream"],
+                      {"id": history_item["id"], "channel_id": history_item["channel_id"], "data": message},
+                      max_len=redis_settings["stream_max_len"])
+
+    await pipeline.execute()
@@ -1,11 +1,17 @@
+import base64
+import binascii
 import json
+from datetime import datetime, timezone
 from functools import wraps
 from json import JSONDecodeError
-from typing import Callable, Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
 
 from aiohttp import web
-from marshmallow import Schema, fields, pre_dump, validate
+from marshmallow import Schema, fields, missing, post_load, pre_dump, utils, validate
 from marshmallow.exceptions import ValidationError
+from multidict import MultiDictProxy
+
+from api.settings import settings
 
 
 class BaseSchema(Schema):
@@ -17,8 +23,59 @@ class BaseSchema(Schema):
         return data
 
 
+def encode_cursor(record_id: int, created_at: datetime = None) -> str:
+    value = str(record_id) if created_at is None else f"{record_id}:{int(created_at.timestamp())}"
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, Optional[datetime]]:
+    padded_cursor = cursor + "=" * (-len(cursor) % 4)
+    record_id, _, timestamp = base64.urlsafe_b64decode(padded_cursor.encode("utf-8")).decode("utf-8").partition(":")
+    # created_at is stored without time zone, in UTC
+    created_at = datetime.fromtimestamp(int(timestamp), timezone.utc).replace(tzinfo=None) if timestamp else None
+    return int(record_id), created_at
+
+
+class Cursor(fields.Field):
+    """Opaque pagination cursor wrapping the ID of the last record of a page, and its creation time for history"""
+
+    default_error_messages = {"invalid": "Not a valid cursor."}
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if not value:
+            return None
+
+        return encode_cursor(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            record_id, created_at = decode_cursor(value)
+        except (binascii.Error, UnicodeDecodeError, ValueError, OverflowError, OSError):
+            self.fail("invalid")
+
+        if record_id < 1:
+            self.fail("invalid")
+
+        return record_id, created_at
+
+
 class RequestQueryPaginationSchema(Schema):
     offset = fields.Integer(missing=0, default=0, validate=validate.Range(min=0))
+    before_id = fields.Integer(missing=0, default=0, validate=validate.Range(min=1))
+    cursor = Cursor(missing=0, load_only=True)
+
+    @post_load
+    def merge_cursor(self, data: Dict, **kwargs) -> Dict:
+        # the opaque cursor is just another way of passing before_id, history cursors also bound created_at
+        cursor = data.pop("cursor", 0)
+
+        if cursor:
+            data["before_id"], created_at = cursor
+
+            if created_at is not None:
+                data["before_created_at"] = created_at
+
+        return data
 
 
 class SongSchema(BaseSchema):
@@ -33,6 +90,14 @@ class ChannelSchema(BaseSchema):
 
 
 class ChannelExtraSchema(ChannelSchema):
+    history_id = fields.Integer(default=0)
+    song_id = fields.Integer(required=True)
+    song_title = fields.Str(required=True)
+
+
+class NowPlayingSchema(BaseSchema):
+    channel_id = fields.Integer(required=True)
+    history_id = fields.Integer(required=True)
     song_id = fields.Integer(required=True)
     song_title = fields.Str(required=True)
 
@@ -55,6 +120,10 @@ class HistoryRequestQuerySchema(RequestQueryPaginationSchema):
     channel_id = fields.Integer(missing=0, default=0, validate=validate.Range(min=1))
 
 
+class HistoryEventsRequestQuerySchema(Schema):
+    channel_id = fields.List(fields.Integer(validate=validate.Range(min=1)), missing=list)
+
+
 class UserSchema(BaseSchema):
     id = fields.Integer(required=True, dump_only=True)
     sub = fields.String(required=True)
@@ -84,6 +153,27 @@ class BookmarksRequestBodySchema(BookmarkSchema):
         fields = ("song_id",)
 
 
+class BookmarksBatchRequestBodySchema(Schema):
+    song_ids = fields.List(fields.Integer(validate=validate.Range(min=1)), required=True,
+                           validate=validate.Length(min=1, max=settings["bookmarks"]["batch_size"]))
+
+
+class BookmarksBatchDeleteRequestBodySchema(Schema):
+    bookmark_ids = fields.List(fields.Integer(validate=validate.Range(min=1)), required=True,
+                               validate=validate.Length(min=1, max=settings["bookmarks"]["batch_size"]))
+
+
+class BookmarksBatchResultSchema(Schema):
+    song_id = fields.Integer(required=True)
+    bookmark = fields.Nested(BookmarkSchema, allow_none=True)
+    error = fields.Str()
+
+
+class BookmarksBatchDeleteResultSchema(Schema):
+    bookmark_id = fields.Integer(required=True)
+    deleted = fields.Boolean(required=True)
+
+
 class HTTPClientErrorSchema(Schema):
     detail = fields.Str(required=True)
 
@@ -93,6 +183,92 @@ class HTTPValidationErrorSchema(Schema):
                                                                            values=fields.List(fields.Str()))))
 
 
+def serialize_integer(value: Any) -> int:
+    if value is True or value is False:
+        raise TypeError("value must be a Number, not a boolean.")
+
+    return int(value)
+
+
+def serialize_string(value: Any) -> str:
+    return value if type(value) is str else utils.ensure_text_type(value)
+
+
+def serialize_datetime(value: datetime) -> str:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc).isoformat()
+
+    return value.astimezone(timezone.utc).isoformat()
+
+
+class Dumper:
+    """Output of `schema.dump` for mappings such as database records, built without marshmallow
+
+    Plain integer, string and ISO datetime fields are converted directly, any other field falls back
+    to its own `_serialize`. Fields keep the order of `schema.fields`, so the JSON is byte-identical.
+    """
+
+    def __init__(self, schema: Schema) -> None:
+        self.fields = [(field.attribute or name, field.data_key or name, field.default, self.serializer(name, field))
+                       for name, field in schema.fields.items() if not field.load_only]
+
+    @staticmethod
+    def serializer(name: str, field: fields.Field) -> Callable[[Any], Any]:
+        if type(field) is fields.Integer and not field.strict and not field.as_string:
+            return serialize_integer
+
+        if type(field) in (fields.String, fields.Str):
+            return serialize_string
+
+        if type(field) is fields.DateTime and field.format in (None, "iso", "iso8601") and not field.localtime:
+            return serialize_datetime
+
+        return lambda value: field._serialize(value, name, None)
+
+    def dump(self, row: Mapping) -> Dict:
+        data = {}
+
+        for attribute, key, default, serializer in self.fields:
+            value = row.get(attribute, missing)
+
+            if value is missing:
+                if default is missing:
+                    continue
+
+                value = default() if callable(default) else default
+
+            data[key] = None if value is None else serializer(value)
+
+        return data
+
+    def dump_many(self, rows: Iterable[Mapping]) -> List[Dict]:
+        return [self.dump(row) for row in rows]
+
+
+channel_dumper = Dumper(ChannelSchema())
+channel_extra_dumper = Dumper(ChannelExtraSchema())
+history_dumper = Dumper(HistorySchema())
+bookmark_dumper = Dumper(BookmarkSchema())
+
+
+def dumps(data: Any) -> bytes:
+    """JSON body exactly as `web.json_response` would encode it"""
+    return json.dumps(data).encode("utf-8")
+
+
+def query_to_dict(schema: Schema, query: MultiDictProxy) -> Dict:
+    """Keep every value of repeated query parameters declared as lists"""
+    data = {}
+
+    for key in query.keys():
+        if isinstance(schema.fields.get(key), fields.List):
+            data[key] = query.getall(key)
+        else:
+            data[key] = query[key]
+
+    return data
+
+
 def request_validation(query_schema: Schema = None, body_schema: Schema = None, path_schema: Schema = None) -> Callable:
     def handler_wrapper(handler: Callable) -> Callable:
         @wraps(handler)
@@ -108,7 +284,7 @@ def request_validation(query_schema: Schema = None, body_schema: Schema = None,
 
             if query_schema:
                 try:
-                    query = query_schema.load(dict(request.query))
+                    query = query_schema.load(query_to_dict(query_schema, request.query))
                     request["query"] = query
                 except ValidationError as e:
                     errors["query"] = e.messages
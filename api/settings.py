@@ -20,27 +20,89 @@ settings = {
         "port": env("REDIS_PORT", cast=int, default=None),
         "database": env("REDIS_DB", cast=int, default=0),
         "channel": env("REDIS_CHANNEL", default="history"),
+        "stream": env("REDIS_STREAM", default="history:events"),
+        "stream_max_len": env("REDIS_STREAM_MAX_LEN", cast=int, default=1000),
+        "transport": env("REDIS_TRANSPORT", default="pubsub"),
+        "stream_block": env("REDIS_STREAM_BLOCK", cast=int, default=5000),
+        "stream_batch_size": env("REDIS_STREAM_BATCH_SIZE", cast=int, default=100),
+        "reconnect_interval": env("REDIS_RECONNECT_INTERVAL", cast=float, default=1.0),
     },
     "pagination": {
-        "limit": 50
+        "limit": 50,
+        "cursor_header": "X-Next-Cursor"
     },
     "crawler": {
         "interval": env("API_CRAWLER_INTERVAL", cast=int, default=30),
+        "channels_interval": env("API_CRAWLER_CHANNELS_INTERVAL", cast=dict, subcast=int, default={}),
         "backoff_interval": env("API_CRAWLER_BACKOFF_INTERVAL", cast=int, default=300),
+        "circuit_breaker": {
+            "threshold": env("API_CRAWLER_CIRCUIT_BREAKER_THRESHOLD", cast=int, default=5),
+            "timeout": env("API_CRAWLER_CIRCUIT_BREAKER_TIMEOUT", cast=int, default=600)
+        },
+        "writer": {
+            "mode": env("API_CRAWLER_WRITER_MODE", default="immediate"),
+            "flush_interval": env("API_CRAWLER_WRITER_FLUSH_INTERVAL", cast=float, default=1.0),
+            "max_batch_size": env("API_CRAWLER_WRITER_MAX_BATCH_SIZE", cast=int, default=100)
+        },
+        "reconcile_interval": env("API_CRAWLER_RECONCILE_INTERVAL", cast=int, default=600),
+        "state_key": env("API_CRAWLER_STATE_KEY", default="crawler:channels"),
+        "sharding": {
+            "enabled": env("API_CRAWLER_SHARDING", cast=bool, default=False),
+            "lease_ttl": env("API_CRAWLER_LEASE_TTL", cast=int, default=15000),
+            "prefix": env("API_CRAWLER_LEASE_PREFIX", default="crawler:lease")
+        },
+        "http": {
+            "connect_timeout": env("API_CRAWLER_CONNECT_TIMEOUT", cast=float, default=5.0),
+            "read_timeout": env("API_CRAWLER_READ_TIMEOUT", cast=float, default=10.0),
+            # waiting for a pooled connection included
+            "pool_timeout": env("API_CRAWLER_POOL_TIMEOUT", cast=float, default=10.0),
+            "total_timeout": env("API_CRAWLER_TOTAL_TIMEOUT", cast=float, default=30.0),
+            "max_response_size": env("API_CRAWLER_MAX_RESPONSE_SIZE", cast=int, default=65536),
+            # 0 sizes the pool to the channels, which mostly share a single host
+            "limit_per_host": env("API_CRAWLER_LIMIT_PER_HOST", cast=int, default=0),
+            "dns_cache_ttl": env("API_CRAWLER_DNS_CACHE_TTL", cast=int, default=300),
+            "hedge_delay": env("API_CRAWLER_HEDGE_DELAY", cast=float, default=0.0)
+        },
+        "partitions": {
+            "months_ahead": env("API_CRAWLER_PARTITIONS_MONTHS_AHEAD", cast=int, default=3),
+            "interval": env("API_CRAWLER_PARTITIONS_INTERVAL", cast=int, default=86400)
+        },
+        "songs_cache": {
+            "size": env("API_CRAWLER_SONGS_CACHE_SIZE", cast=int, default=10000),
+            "prewarm": env("API_CRAWLER_SONGS_CACHE_PREWARM", cast=bool, default=False),
+            # latest history items the prewarm counts plays in
+            "prewarm_history": env("API_CRAWLER_SONGS_CACHE_PREWARM_HISTORY", cast=int, default=100000)
+        },
         "headers": {
             "User-Agent": env("API_CRAWLER_AGENT", default="Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_3) "
                                                            "AppleWebKit/537.36 (KHTML, like Gecko) "
                                                            "Safari/537.36")
         }
     },
+    "cache": {
+        "history": {
+            "size": env("API_CACHE_HISTORY_SIZE", cast=int, default=256),
+            "max_age": env("API_CACHE_HISTORY_MAX_AGE", cast=float, default=60.0)
+        }
+    },
     "openapi": {
         "route": {
             "url": "/openapi.json",
             "name": "openapi"
         }
     },
+    "metrics": {
+        # per-process counters, only for deployments where the API is not reachable from the internet
+        "enabled": env("API_METRICS_ENABLED", cast=bool, default=False)
+    },
+    "bookmarks": {
+        "batch_size": env("API_BOOKMARKS_BATCH_SIZE", cast=int, default=100)
+    },
     "sse": {
-        "retry": 30
+        "retry": 30,
+        "queue_size": env("API_SSE_QUEUE_SIZE", cast=int, default=32),
+        "now_playing_event": "now_playing",
+        "reset_event": "reset"
     },
     "cors": {
         "allowed": env("API_CORS_ALLOWED", cast=bool, default=False),
@@ -92,6 +154,9 @@ assert settings["oauth2"]["google"]["client_secret"] is not None
 assert settings["oauth2"]["google"]["redirect_url"] is not None
 assert settings["csrf"]["cookie"]["domain"] is not None
 
+assert settings["redis"]["transport"] in ("pubsub", "streams")
+assert settings["crawler"]["writer"]["mode"] in ("immediate", "batch")
+
 if settings["cors"]["allowed"]:
     assert settings["cors"]["origin"] is not None
 
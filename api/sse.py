@@ -1,15 +1,19 @@
 import asyncio
 import json
+
+import aioredis
 from _weakrefset import WeakSet
-from typing import Optional, Dict
+from collections import defaultdict
+from typing import Optional, Dict, Iterable, List, Tuple
 
 from aiohttp import web
 from aiohttp.typedefs import LooseHeaders
 from aiohttp_sse import EventSourceResponse, _ContextManager
 
+from api import metrics
 from api.cors import generate_cors_headers
+from api.database import fetch_channels_extra
 from api.logger import get_logger
-from api.schemas import HistorySchema
 from api.settings import settings
 
 
@@ -29,9 +33,19 @@ class SSEResponse(EventSourceResponse):
         self.headers.extend(generate_cors_headers())
         self.headers['X-Accel-Buffering'] = 'no'  # Nginx unbuffered responses for HTTP streaming application
 
+        # each client gets its own bounded queue and writer, so a slow client cannot block the others
+        self.queue = asyncio.Queue(maxsize=settings["sse"]["queue_size"])
+        self._writer_task = None
+        self.channel_ids = ()
+
+        # live events received while missed events are replayed, sent once the replay is done
+        self.replaying = False
+        self.held: List[Tuple[int, bytes]] = []
+
     async def prepare(self, request: web.Request) -> None:
         if not self.prepared:
             await super().prepare(request)
+            self._writer_task = asyncio.create_task(self._writer())
         else:
             # hackish way to check if connection alive
             # should be updated once we have proper API in aiohttp
@@ -43,16 +57,181 @@ class SSEResponse(EventSourceResponse):
     def enable_compression(self, force: bool = False) -> None:
         raise NotImplementedError
 
+    def enqueue(self, frame: bytes, event_id: int = 0) -> bool:
+        if self.replaying:
+            if len(self.held) >= self.queue.maxsize:
+                return False
+
+            self.held.append((event_id, frame))
+            return True
+
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            return False
+
+        return True
+
+    async def replay(self, frames: List[Tuple[int, bytes]], last_event_id: int) -> None:
+        for event_id, frame in frames:
+            await self.write(frame)
+            last_event_id = max(last_event_id, event_id)
+
+        held, self.held, self.replaying = self.held, [], False
+
+        for event_id, frame in held:
+            if event_id > last_event_id:
+                self.enqueue(frame, event_id)
+
+    def stop_streaming(self) -> None:
+        super().stop_streaming()
+
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.write(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.debug("Cannot write to a SSE connection", exc_info=True)
+            self.stop_streaming()
+
+
+def encode_sse_frame(data: str, id: int = None, event: str = None, retry: int = None) -> bytes:
+    """Same wire format as EventSourceResponse.send, encoded once and shared by every connection"""
+    lines = []
+
+    if id is not None:
+        lines.append(f"id: {id}\r\n")
+
+    if event is not None:
+        lines.append(f"event: {event}\r\n")
+
+    for chunk in data.split("\r\n"):
+        lines.append(f"data: {chunk}\r\n")
+
+    if retry is not None:
+        lines.append(f"retry: {retry}\r\n")
+
+    lines.append("\r\n")
+    return "".join(lines).encode("utf-8")
+
+
+def add_sse_stream(app: web.Application, stream: SSEResponse, channel_ids: Iterable[int] = ()) -> None:
+    """Register a stream for the given channels, or for every channel when none is given"""
+    stream.channel_ids = tuple(channel_ids) or (0,)
+    app["sse_streams"].add(stream)
+
+    for channel_id in stream.channel_ids:
+        app["sse_channel_streams"][channel_id].add(stream)
+
+
+def discard_sse_stream(app: web.Application, stream: SSEResponse) -> None:
+    app["sse_streams"].discard(stream)
+
+    for channel_id in stream.channel_ids:
+        app["sse_channel_streams"][channel_id].discard(stream)
+
+
+def broadcast(app: web.Application, frame: bytes, event_id: int, channel_id: int) -> None:
+    # only the streams interested in this channel are touched
+    streams = set(app["sse_channel_streams"][0]) | set(app["sse_channel_streams"].get(channel_id, ()))
+
+    for stream in streams:
+        if not stream.enqueue(frame, event_id):
+            log.warning("Evicting a slow SSE connection")
+            metrics.increment("sse_evicted_connections")
+            discard_sse_stream(app, stream)
+            stream.stop_streaming()
+
+    metrics.increment("sse_messages")
+
+
+def parse_stream_fields(fields: Dict) -> Tuple[int, int, str]:
+    message = fields[b"data"].decode("utf-8")
+
+    if b"channel_id" in fields:
+        channel_id = int(fields[b"channel_id"])
+    else:
+        channel_id = json.loads(message)["channel_id"]
+
+    return int(fields[b"id"]), channel_id, message
+
 
 def sse_response(request: web.Request, *, status: int = 200, reason: str = None, headers: Dict = None) -> _ContextManager:
     sse = SSEResponse(status=status, reason=reason, headers=headers)
     return _ContextManager(sse._prepare(request))
 
 
+async def replay_history_events(app: web.Application, stream: SSEResponse, last_event_id: int,
+                                frames: List[Tuple[int, bytes]] = None) -> None:
+    """Send the events missed since Last-Event-ID from the Redis recent events stream, without touching Postgres
+
+    The stream is read backwards one batch at a time down to Last-Event-ID. When it was already trimmed
+    past Last-Event-ID a reset event is sent instead, so the client fetches /history again.
+    """
+    redis_settings = settings["redis"]
+    batch_size = redis_settings["stream_batch_size"]
+    missed = []
+    start = "+"
+    reached = False
+
+    while not reached:
+        # the start of the next batches is inclusive, their first entry was already read
+        count = batch_size if start == "+" else batch_size + 1
+        entries = await app["redis"].xrevrange(redis_settings["stream"], start=start, count=count)
+        page = entries if start == "+" else entries[1:]
+
+        for _, fields in page:
+            event_id, channel_id, message = parse_stream_fields(fields)
+
+            if event_id <= last_event_id:
+                reached = True
+                break
+
+            if 0 in stream.channel_ids or channel_id in stream.channel_ids:
+                missed.append((event_id, message))
+
+        if len(entries) < count:
+            break
+
+        start = entries[-1][0]
+
+    if reached:
+        missed_frames = [(event_id, encode_sse_frame(message,
+                                                     id=event_id,
+                                                     event=redis_settings["channel"],
+                                                     retry=settings["sse"]["retry"]))
+                         for event_id, message in reversed(missed)]
+        log.info(f"Replaying {len(missed_frames)} SSE events after Last-Event-ID={last_event_id}")
+        metrics.increment("sse_replayed_events", len(missed_frames))
+    else:
+        missed_frames = [(0, encode_sse_frame(json.dumps({"last_event_id": last_event_id}),
+                                              event=settings["sse"]["reset_event"],
+                                              retry=settings["sse"]["retry"]))]
+        log.info(f"Resetting a SSE connection, Last-Event-ID={last_event_id} is no longer in the recent events")
+        metrics.increment("sse_reset_connections")
+
+    await stream.replay((frames or []) + missed_frames, last_event_id)
+
+
 async def create_sse_redis_subscriber(app: web.Application) -> None:
     app["sse_streams"] = WeakSet()
+    app["sse_channel_streams"] = defaultdict(WeakSet)
+    app["now_playing"] = {}
+    app["history_events_synced"] = asyncio.Event()
+    app["history_events_live"] = False
     app["sse_subscriber"] = asyncio.create_task(sse_redis_subscriber(app))
 
+    # the first requests are served once the now playing map is loaded, unless the subscriber gave up
+    synced = asyncio.ensure_future(app["history_events_synced"].wait())
+    await asyncio.wait([synced, app["sse_subscriber"]], return_when=asyncio.FIRST_COMPLETED)
+    synced.cancel()
+
 
 async def cancel_sse_redis_subscriber(app: web.Application) -> None:
     if not app["sse_subscriber"].cancelled():
@@ -72,28 +251,190 @@ async def close_sse_streams(app: web.Application) -> None:
 
     await asyncio.gather(*waiters)
     app["sse_streams"].clear()
+    app["sse_channel_streams"].clear()
+
+
+def set_history_events_live(app: web.Application, live: bool) -> None:
+    """The history cache and the cheap history validators only follow the database while events are received"""
+    if not live:
+        app["history_cache"].clear()
+
+    app["history_events_live"] = live
+
+
+def broadcast_history_message(app: web.Application, message: str, history: Dict) -> None:
+    update_now_playing(app, history)
+    app["history_cache"].add_history_item(history)
+    frame = encode_sse_frame(message,
+                             id=history["id"],
+                             event=settings["redis"]["channel"],
+                             retry=settings["sse"]["retry"])
+    broadcast(app, frame, history["id"], history["channel_id"])
+
+
+async def load_now_playing(app: web.Application) -> None:
+    """Seed the per process "current song per channel" map, then the history events keep it up to date
+
+    Meant to run once the subscriber position is taken, so no event between the two is lost. Events
+    received while loading are newer than the loaded rows and are kept.
+    """
+    channels = await fetch_channels_extra(app["database"])
+
+    for channel in channels:
+        if channel.get("song_id"):
+            update_now_playing(app, {
+                "channel_id": channel["id"],
+                "id": channel["history_id"],
+                "song_id": channel["song_id"],
+                "song_title": channel["song_title"],
+            })
+
+    app["history_events_synced"].set()
+
+
+def update_now_playing(app: web.Application, history: Dict) -> None:
+    current = app["now_playing"].get(history["channel_id"])
+
+    # events of a channel may arrive out of order when several crawlers publish
+    if current and current["history_id"] > history["id"]:
+        return
+
+    app["now_playing"][history["channel_id"]] = {
+        "channel_id": history["channel_id"],
+        "history_id": history["id"],
+        "song_id": history["song_id"],
+        "song_title": history["song_title"],
+    }
+
+
+def get_now_playing(app: web.Application, channel_ids: Iterable[int] = ()) -> List[Dict]:
+    channel_ids = set(channel_ids)
+    return [item for channel_id, item in sorted(app["now_playing"].items())
+            if not channel_ids or channel_id in channel_ids]
+
+
+async def open_sse_stream(app: web.Application, stream: SSEResponse, channel_ids: Iterable[int],
+                          last_event_id: int = 0) -> None:
+    """Register the stream, with the now playing snapshot as its first event and the missed events after it"""
+    channel_ids = tuple(channel_ids)
+    snapshot = encode_sse_frame(json.dumps(get_now_playing(app, channel_ids)),
+                                event=settings["sse"]["now_playing_event"],
+                                retry=settings["sse"]["retry"])
+
+    # no await until the snapshot is queued, so no live event can slip in front of it
+    stream.replaying = last_event_id > 0
+    add_sse_stream(app, stream, channel_ids)
+
+    if stream.replaying:
+        await replay_history_events(app, stream, last_event_id, [(0, snapshot)])
+    else:
+        stream.enqueue(snapshot)
 
 
 async def sse_redis_subscriber(app: web.Application) -> None:
-    channel, *_ = await app["redis"].subscribe(settings["redis"]["channel"])
-    history_schema = HistorySchema()
+    if settings["redis"]["transport"] == "streams":
+        await sse_redis_stream_subscriber(app)
+    else:
+        await sse_redis_pubsub_subscriber(app)
+
+
+async def sse_redis_stream_subscriber(app: web.Application) -> None:
+    """Read history events from the Redis stream, resuming from the last delivered entry after any Redis error"""
+    redis_settings = settings["redis"]
+    latest_id = None
+    redis = None
 
     try:
-        async for message in channel.iter(encoding="utf-8"):
-            history = history_schema.loads(message)
-            fs = []
+        while True:
+            try:
+                if redis is None or redis.closed:
+                    # blocking reads need their own connection, they would stall the shared pool
+                    redis = await aioredis.create_redis(redis_settings["url"])
+
+                if latest_id is None:
+                    # start after the newest entry, "$" would skip entries added between two blocking reads
+                    newest_entries = await redis.xrevrange(redis_settings["stream"], count=1)
+                    latest_id = newest_entries[0][0] if newest_entries else b"0-0"
+
+                if not app["history_events_synced"].is_set():
+                    # the position is taken first, entries written while loading are read right after
+                    await load_now_playing(app)
+
+                entries = await redis.xread([redis_settings["stream"]],
+                                            timeout=redis_settings["stream_block"],
+                                            count=redis_settings["stream_batch_size"],
+                                            latest_ids=[latest_id])
+
+                for _, entry_id, fields in entries:
+                    message = fields[b"data"].decode("utf-8")
+                    broadcast_history_message(app, message, json.loads(message))
+                    latest_id = entry_id
+
+                set_history_events_live(app, True)
+                metrics.increment("sse_stream_reads")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Cannot read history events stream, reconnecting")
+                metrics.increment("sse_stream_reconnects")
+                set_history_events_live(app, False)
 
-            for stream in app['sse_streams']:
-                fs.append(stream.send(message,
-                                      id=history["id"],
-                                      event=settings["redis"]["channel"],
-                                      retry=settings["sse"]["retry"]))
+                if redis is not None:
+                    redis.close()
+                    redis = None
 
-            await asyncio.gather(*fs)
+                await asyncio.sleep(redis_settings["reconnect_interval"])
     except asyncio.CancelledError:
         pass
-    except Exception as e:
-        log.exception("Fatal error", exc_info=True)
     finally:
+        set_history_events_live(app, False)
+
+        if redis is not None:
+            redis.close()
+
+        await close_sse_streams(app)
+
+
+async def sse_redis_pubsub_subscriber(app: web.Application) -> None:
+    """Receive history events from the Redis channel, subscribing again after any Redis error
+
+    Messages published while unsubscribed are lost, the now playing map is loaded again on every subscription.
+    """
+    redis_settings = settings["redis"]
+    redis = None
+
+    try:
+        while True:
+            try:
+                # subscribing takes a connection out of the shared pool, a dedicated one is closed on errors instead
+                redis = await aioredis.create_redis(redis_settings["url"])
+                channel, *_ = await redis.subscribe(redis_settings["channel"])
+                # subscribed first, messages published while loading wait in the channel
+                await load_now_playing(app)
+                set_history_events_live(app, True)
+
+                async for message in channel.iter(encoding="utf-8"):
+                    broadcast_history_message(app, message, json.loads(message))
+
+                raise ConnectionError("History events channel closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Cannot receive history events, subscribing again")
+                metrics.increment("sse_pubsub_reconnects")
+                set_history_events_live(app, False)
+
+                if redis is not None:
+                    redis.close()
+                    redis = None
+
+                await asyncio.sleep(redis_settings["reconnect_interval"])
+    except asyncio.CancelledError:
+        pass
+    finally:
+        set_history_events_live(app, False)
+
+        if redis is not None:
+            redis.close()
+
         await close_sse_streams(app)
-        await cancel_sse_redis_subscriber(app)
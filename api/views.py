@@ -1,17 +1,49 @@
+from datetime import datetime
+from typing import Optional
+
 from aiohttp import web
 
+from api import metrics
 from api.auth import *
+from api.cache import fetch_history_cached
 from api.csrf import csrf_protection
+from api.etag import (body_response_with_etag, generate_etag, is_not_modified, json_response_with_etag,
+                      not_modified_response)
 from api.database import *
 from api.logger import get_logger
 from api.schemas import *
 from api.settings import settings
-from api.sse import sse_response
+from api.sse import discard_sse_stream, get_now_playing, open_sse_stream, sse_response
 
 
 log = get_logger(__name__)
 
 
+def set_next_cursor(response: web.Response, data: List[Dict], with_created_at: bool = False) -> None:
+    if len(data) == settings["pagination"]["limit"]:
+        created_at = datetime.fromisoformat(data[-1]["created_at"]) if with_created_at else None
+        response.headers[settings["pagination"]["cursor_header"]] = encode_cursor(data[-1]["id"], created_at)
+
+
+def generate_history_etag(app: web.Application, parameters: Dict) -> Optional[str]:
+    """Anonymous pages only change when a row lands in front of them, history is append-only
+
+    Pages without a cursor are versioned by the now playing map, which only follows the database
+    while history events are received, their validators fall back to a hash of the body otherwise.
+    """
+    if parameters["before_id"]:
+        latest_history_id = 0
+    elif not app["history_events_live"]:
+        return None
+    elif parameters["channel_id"]:
+        latest_history_id = app["now_playing"].get(parameters["channel_id"], {}).get("history_id", 0)
+    else:
+        latest_history_id = max((item["history_id"] for item in app["now_playing"].values()), default=0)
+
+    return generate_etag("history", parameters["channel_id"], parameters["before_id"], parameters["offset"],
+                         settings["pagination"]["limit"], latest_history_id)
+
+
 async def get_channels_handler(request: web.Request) -> web.Response:
     """Get channels
     ---
@@ -28,10 +60,10 @@ async def get_channels_handler(request: web.Request) -> web.Response:
                         schema:
                             type: array
                             items: ChannelSchema
+            304:
+                description: Not Modified, the If-None-Match header matches the ETag
     """
-    database = request.app["database"]
-    data = await fetch_channels(database)
-    return web.json_response(data)
+    return body_response_with_etag(request, request.app["channels_body"], request.app["channels_etag"])
 
 
 @request_validation(query_schema=HistoryRequestQuerySchema())
@@ -42,7 +74,11 @@ async def get_history_handler(request: web.Request) -> web.Response:
         tags:
             - history
         summary: Get history
-        description: Get up to 100 records per request.
+        description: |
+            Get up to 100 records per request.
+
+            Pass the `X-Next-Cursor` response header value as `cursor` to get the next page.
+            Cursor pagination takes precedence over offset pagination.
         parameters:
             -
                 name: channel_id
@@ -58,27 +94,57 @@ async def get_history_handler(request: web.Request) -> web.Response:
                 description: Retrieve records starting with the offset value, default = 0
                 schema:
                     type: integer
+            -
+                name: before_id
+                in: query
+                required: false
+                description: Retrieve records with an ID lower than the before_id value
+                schema:
+                    type: integer
+            -
+                name: cursor
+                in: query
+                required: false
+                description: Retrieve records following the page which returned this cursor
+                schema:
+                    type: string
         responses:
             200:
                 description: Successful
+                headers:
+                    X-Next-Cursor:
+                        description: Cursor of the next page, missing on the last page
+                        schema:
+                            type: string
                 content:
                     application/json:
                         schema:
                             type: array
                             items: HistorySchema
+            304:
+                description: Not Modified, the If-None-Match header matches the ETag
             422:
                 description: Validation Error
                 content:
                     application/json:
                         schema: HTTPValidationErrorSchema
     """
-    database = request.app["database"]
     session = await get_session(request)
     user_id = session["user_id"] if "user_id" in session else 0
-    data = await fetch_history(database, request["query"], user_id)
-    return web.json_response(data)
+    # bookmarks of signed in users are not versioned, their pages are validated by a hash of the body
+    etag = generate_history_etag(request.app, request["query"]) if not user_id else None
+
+    if etag and is_not_modified(request, etag):
+        return not_modified_response(etag)
+
+    data = await fetch_history_cached(request.app, request["query"], user_id)
+    response = json_response_with_etag(request, data, etag)
+    # the next page is bounded to the partitions up to the last item
+    set_next_cursor(response, data, with_created_at=True)
+    return response
 
 
+@request_validation(query_schema=HistoryEventsRequestQuerySchema())
 async def get_history_events_handler(request: web.Request) -> web.StreamResponse:
     """Get history
     ---
@@ -88,6 +154,29 @@ async def get_history_events_handler(request: web.Request) -> web.StreamResponse
         summary: Get history events
         description: |
             Get real-time notifications over a [SSE](https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events) connection.
+
+            The first event, `now_playing`, holds the current song of each channel.
+            Reconnecting clients sending `Last-Event-ID` receive the recent events they missed next,
+            or a `reset` event when those are no longer kept, after which the history has to be fetched again.
+        parameters:
+            -
+                name: channel_id
+                in: query
+                required: false
+                description: Receive only the events of these channels, repeat the parameter for many channels
+                schema:
+                    type: array
+                    items:
+                        type: integer
+                style: form
+                explode: true
+            -
+                name: Last-Event-ID
+                in: header
+                required: false
+                description: ID of the last received event
+                schema:
+                    type: integer
         security:
             - cookieAuth: []
         responses:
@@ -106,18 +195,83 @@ async def get_history_events_handler(request: web.Request) -> web.StreamResponse
 
     log.info("Opening a SSE connection")
 
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID", 0))
+    except ValueError:
+        last_event_id = 0
+
     sse_stream = await sse_response(request)
-    request.app["sse_streams"].add(sse_stream)
 
     try:
+        await open_sse_stream(request.app, sse_stream, request["query"]["channel_id"], last_event_id)
         await sse_stream.wait()
     finally:
         log.info("Closing a SSE connection")
-        request.app["sse_streams"].discard(sse_stream)
+        discard_sse_stream(request.app, sse_stream)
 
     return sse_stream
 
 
+@request_validation(query_schema=HistoryEventsRequestQuerySchema())
+async def get_now_playing_handler(request: web.Request) -> web.Response:
+    """Get now playing
+    ---
+    get:
+        tags:
+            - history
+        summary: Get now playing
+        description: Get the current song of each channel.
+        parameters:
+            -
+                name: channel_id
+                in: query
+                required: false
+                description: Get only these channels, repeat the parameter for many channels
+                schema:
+                    type: array
+                    items:
+                        type: integer
+                style: form
+                explode: true
+        responses:
+            200:
+                description: Successful
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items: NowPlayingSchema
+            422:
+                description: Validation Error
+                content:
+                    application/json:
+                        schema: HTTPValidationErrorSchema
+    """
+    data = get_now_playing(request.app, request["query"]["channel_id"])
+    return web.json_response(data)
+
+
+async def get_metrics_handler(request: web.Request) -> web.Response:
+    """Get metrics
+    ---
+    get:
+        tags:
+            - metrics
+        summary: Get metrics
+        description: Get the counters of the API process which handles the request, served when `API_METRICS_ENABLED` is set.
+        responses:
+            200:
+                description: Successful
+                content:
+                    application/json:
+                        schema:
+                            type: object
+                            additionalProperties:
+                                type: integer
+    """
+    return web.json_response(metrics.snapshot())
+
+
 @private_path
 async def get_user_handler(request: web.Request) -> web.Response:
     """Get user info
@@ -227,7 +381,11 @@ async def get_user_bookmarks_handler(request: web.Request) -> web.Response:
         tags:
             - user
         summary: Get user bookmarks
-        description: Get up to 100 records per request.
+        description: |
+            Get up to 100 records per request.
+
+            Pass the `X-Next-Cursor` response header value as `cursor` to get the next page.
+            Cursor pagination takes precedence over offset pagination.
         parameters:
             -
                 name: offset
@@ -236,16 +394,37 @@ async def get_user_bookmarks_handler(request: web.Request) -> web.Response:
                 description: Get records starting with the offset value, default = 0
                 schema:
                     type: integer
+            -
+                name: before_id
+                in: query
+                required: false
+                description: Get records with an ID lower than the before_id value
+                schema:
+                    type: integer
+            -
+                name: cursor
+                in: query
+                required: false
+                description: Get records following the page which returned this cursor
+                schema:
+                    type: string
         security:
             - cookieAuth: []
         responses:
             200:
                 description: Successful
+                headers:
+                    X-Next-Cursor:
+                        description: Cursor of the next page, missing on the last page
+                        schema:
+                            type: string
                 content:
                     application/json:
                         schema:
                             type: array
                             items: BookmarkSchema
+            304:
+                description: Not Modified, the If-None-Match header matches the ETag
             401:
                 description: Unauthorized
                 content:
@@ -260,7 +439,9 @@ async def get_user_bookmarks_handler(request: web.Request) -> web.Response:
     database = request.app["database"]
     session = await get_session(request)
     data = await fetch_bookmarks(database, request["query"], session["user_id"])
-    return web.json_response(data)
+    response = json_response_with_etag(request, data)
+    set_next_cursor(response, data)
+    return response
 
 
 @private_path
@@ -304,21 +485,13 @@ async def post_user_bookmarks_handler(request: web.Request) -> web.Response:
     """
     database = request.app["database"]
     session = await get_session(request)
-    song = await fetch_song(database, request["body"]["song_id"])
+    data = await upsert_bookmark(database, session["user_id"], request["body"]["song_id"])
 
-    if not song:
+    if not data:
         validation_error_schema = HTTPValidationErrorSchema()
         data = validation_error_schema.dump({"detail": {"body": {"song_id": ["Not found."]}}})
         raise web.HTTPUnprocessableEntity(text=json.dumps(data), content_type="application/json")
 
-    bookmark = await fetch_bookmark_by_user_and_song(database, session["user_id"], request["body"]["song_id"])
-
-    if bookmark:
-        bookmark_id = bookmark["id"]
-    else:
-        bookmark_id = await insert_bookmark(database, session["user_id"], request["body"]["song_id"])
-
-    data = await fetch_bookmark(database, bookmark_id)
     return web.json_response(data)
 
 
@@ -374,3 +547,109 @@ async def delete_user_bookmarks_handler(request: web.Request) -> web.Response:
 
     await delete_bookmark(database, request["path"]["bookmark_id"])
     return web.json_response({})
+
+
+@private_path
+@csrf_protection
+@request_validation(body_schema=BookmarksBatchRequestBodySchema())
+async def post_user_bookmarks_batch_handler(request: web.Request) -> web.Response:
+    """Add user bookmarks
+    ---
+    post:
+        tags:
+            - user
+        summary: Add user bookmarks
+        description: Bookmark many songs at once, results follow the order of the given song IDs.
+        requestBody:
+            required: true
+            content:
+                application/json:
+                    schema: BookmarksBatchRequestBodySchema
+        security:
+            - cookieAuth: []
+        responses:
+            200:
+                description: Successful
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items: BookmarksBatchResultSchema
+            401:
+                description: Unauthorized
+                content:
+                    application/json:
+                        schema: HTTPClientErrorSchema
+            415:
+                description: Unsupported Media Type
+                content:
+                    application/json:
+                        schema: HTTPClientErrorSchema
+            422:
+                description: Validation Error
+                content:
+                    application/json:
+                        schema: HTTPValidationErrorSchema
+    """
+    database = request.app["database"]
+    session = await get_session(request)
+    song_ids = list(dict.fromkeys(request["body"]["song_ids"]))
+    bookmarks = await upsert_bookmarks(database, session["user_id"], song_ids)
+    song_bookmarks = {bookmark["song_id"]: bookmark for bookmark in bookmarks}
+
+    data = [{"song_id": song_id, "bookmark": song_bookmarks[song_id]} if song_id in song_bookmarks
+            else {"song_id": song_id, "bookmark": None, "error": "Not found."}
+            for song_id in song_ids]
+    return web.json_response(data)
+
+
+@private_path
+@csrf_protection
+@request_validation(body_schema=BookmarksBatchDeleteRequestBodySchema())
+async def delete_user_bookmarks_batch_handler(request: web.Request) -> web.Response:
+    """Delete user bookmarks
+    ---
+    delete:
+        tags:
+            - user
+        summary: Delete user bookmarks
+        description: Delete many bookmarks at once, results follow the order of the given bookmark IDs.
+        requestBody:
+            required: true
+            content:
+                application/json:
+                    schema: BookmarksBatchDeleteRequestBodySchema
+        security:
+            - cookieAuth: []
+        responses:
+            200:
+                description: Successful
+                content:
+                    application/json:
+                        schema:
+                            type: array
+                            items: BookmarksBatchDeleteResultSchema
+            401:
+                description: Unauthorized
+                content:
+                    application/json:
+                        schema: HTTPClientErrorSchema
+            415:
+                description: Unsupported Media Type
+                content:
+                    application/json:
+                        schema: HTTPClientErrorSchema
+            422:
+                description: Validation Error
+                content:
+                    application/json:
+                        schema: HTTPValidationErrorSchema
+    """
+    database = request.app["database"]
+    session = await get_session(request)
+    bookmark_ids = list(dict.fromkeys(request["body"]["bookmark_ids"]))
+    deleted_bookmark_ids = set(await delete_bookmarks(database, session["user_id"], bookmark_ids))
+
+    data = [{"bookmark_id": bookmark_id, "deleted": bookmark_id in deleted_bookmark_ids}
+            for bookmark_id in bookmark_ids]
+    return web.json_response(data)
@@ -1,17 +1,30 @@
 import asyncio
+import hashlib
 import html
+import json
 import logging
+import random
 import re
+import time
 from http import HTTPStatus
-from typing import Dict, List
+from typing import Dict
 
-from aiohttp import ClientSession
-from aioredis import create_redis
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, hdrs
+from aioredis import Redis, create_redis
 from databases import Database
 
-from api.database import fetch_channels_extra, fetch_song_by_title, insert_song, insert_history_item, fetch_history_item
+from api.cache import LRUCache
+from api.database import fetch_channels_extra, fetch_channel_extra, fetch_songs_most_played
 from api.settings import settings
 from api.logger import setup_logging
+from crawler.lease import LeaseCoordinator, LeaseManager, generate_worker_id
+from crawler.metrics import LatencyHistogram
+from crawler.partitions import maintain_history_partitions
+from crawler.writer import HistoryWriter
+
+
+class ChannelResponseError(Exception):
+    pass
 
 
 def extract(content: str):
@@ -22,65 +35,314 @@ def extract(content: str):
     return song_title
 
 
-async def fetch_channel_content(channel: Dict, channel_url: str, session: ClientSession):
-    async with session.get(channel_url) as response:
-        return channel, response.status, await response.read()
+def create_client_session(channels_count: int) -> ClientSession:
+    http_settings = settings["crawler"]["http"]
+    # every channel may have a hedged request in flight next to its own
+    limit_per_host = http_settings["limit_per_host"] or channels_count * (2 if http_settings["hedge_delay"] else 1)
+    timeout = ClientTimeout(total=http_settings["total_timeout"], connect=http_settings["pool_timeout"],
+                            sock_connect=http_settings["connect_timeout"], sock_read=http_settings["read_timeout"])
+    connector = TCPConnector(limit=0, limit_per_host=limit_per_host, ttl_dns_cache=http_settings["dns_cache_ttl"])
+    return ClientSession(headers=settings["crawler"]["headers"], timeout=timeout, connector=connector)
 
 
-async def fetch_channels_content(channels: List[Dict]):
-    async with ClientSession(headers=settings["crawler"]["headers"]) as session:
-        tasks = []
+async def fetch_channel_content(channel: Dict, channel_url: str, session: ClientSession, headers: Dict = None):
+    max_response_size = settings["crawler"]["http"]["max_response_size"]
 
-        for channel in channels:
-            tasks.append(asyncio.ensure_future(fetch_channel_content(channel, channel["url"], session)))
+    async with session.get(channel_url, headers=headers) as response:
+        if response.content_length is not None and response.content_length > max_response_size:
+            raise ChannelResponseError(f"response too large (content_length={response.content_length})")
 
-        return await asyncio.gather(*tasks)
+        body = bytearray()
 
+        async for chunk in response.content.iter_chunked(8192):
+            body.extend(chunk)
 
-async def worker(forever: bool = True):
-    setup_logging()
-    log = logging.getLogger(__name__)
+            if len(body) > max_response_size:
+                raise ChannelResponseError(f"response too large (size>{max_response_size})")
 
-    redis = await create_redis(settings["redis"]["url"])
-    database = Database(settings["postgres"]["url"])
-    await database.connect()
+        return channel, response.status, bytes(body), response.headers
+
+
+async def fetch_channel_content_hedged(channel: Dict, session: ClientSession, headers: Dict = None):
+    """Fetch the channel content, firing a second (hedged) request when the first one is slower than the hedge delay"""
+    hedge_delay = settings["crawler"]["http"]["hedge_delay"]
+
+    if not hedge_delay:
+        return await fetch_channel_content(channel, channel["url"], session, headers)
+
+    pending = {asyncio.ensure_future(fetch_channel_content(channel, channel["url"], session, headers))}
+    done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+
+    if not done:
+        pending.add(asyncio.ensure_future(fetch_channel_content(channel, channel["url"], session, headers)))
+
+    try:
+        while True:
+            for future in done:
+                if not future.exception():
+                    return future.result()
+
+            if not pending:
+                # every attempt failed, surface the last error
+                return done.pop().result()
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def create_songs_cache(database: Database) -> LRUCache:
+    cache_settings = settings["crawler"]["songs_cache"]
+    songs_cache = LRUCache(cache_settings["size"])
+
+    if cache_settings["prewarm"] and cache_settings["size"] > 0:
+        songs = await fetch_songs_most_played(database, cache_settings["size"], cache_settings["prewarm_history"])
+
+        # least played first, so the most played songs end up as the most recently used
+        for song in reversed(songs):
+            songs_cache.set(song["title"], song["id"])
+
+    return songs_cache
+
+
+class CircuitBreaker:
+    """Stop polling a channel after too many consecutive failures, then let a single trial poll through"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, timeout: int) -> None:
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+
+    def allow(self, now: float) -> bool:
+        if self.state == self.OPEN and now - self.opened_at >= self.timeout:
+            self.state = self.HALF_OPEN
+
+        return not self.state == self.OPEN
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+
+    def record_failure(self, failures: int, now: float) -> None:
+        if self.state == self.HALF_OPEN or failures >= self.threshold:
+            self.state = self.OPEN
+            self.opened_at = now
+
+
+class ChannelPoller:
+    """Poll one channel on its own schedule, so a slow or failing channel cannot delay the others"""
 
-    while True:
-        sleep_interval = settings["crawler"]["interval"]
+    def __init__(self, channel: Dict, database: Database, redis: Redis, session: ClientSession,
+                 songs_cache: LRUCache, writer: HistoryWriter, stale: bool = False) -> None:
+        crawler_settings = settings["crawler"]
 
-        channels = await fetch_channels_extra(database)
-        responses = await fetch_channels_content(channels)
+        # the crawler is the only writer, so the last song is kept in memory and only reconciled from time to time
+        self.channel = dict(channel)
+        self.reconcile_interval = crawler_settings["reconcile_interval"]
+        self.reconciled_at = None if stale else time.monotonic()
+        self.database = database
+        self.redis = redis
+        self.session = session
+        self.songs_cache = songs_cache
+        self.writer = writer
+        self.latency = LatencyHistogram()
+        self.interval = crawler_settings["channels_interval"].get(str(channel["id"]), crawler_settings["interval"])
+        self.backoff_interval = crawler_settings["backoff_interval"]
+        self.circuit_breaker = CircuitBreaker(**crawler_settings["circuit_breaker"])
+        self.failures = 0
+        self.polls = 0
+        self.last_status = None
+        self.last_error = None
+        self.last_poll_at = None
+        self.next_poll_at = None
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.unchanged_polls = 0
+        self.log = logging.getLogger(f"{__name__}.channel_{channel['id']}")
 
-        for channel, response_status_code, response_body in responses:
-            if not response_status_code == HTTPStatus.OK:
-                sleep_interval = settings["crawler"]["backoff_interval"]
-                log.warning(f"Cannot process response for channel_id= {channel['id']} (status_code={response_status_code})")
-                continue
+    def state(self) -> Dict:
+        return {
+            "channel_id": self.channel["id"],
+            "interval": self.interval,
+            "circuit": self.circuit_breaker.state,
+            "failures": self.failures,
+            "polls": self.polls,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "last_poll_at": self.last_poll_at,
+            "next_poll_at": self.next_poll_at,
+            "song_title": self.channel["song_title"],
+            "unchanged_polls": self.unchanged_polls,
+            "latency": self.latency.snapshot(),
+            # shared by the pollers of a worker
+            "songs_cache": self.songs_cache.stats(),
+        }
 
-            curr_song_title = extract(response_body.decode("utf8"))
-            history_item_id = 0
+    def next_delay(self) -> float:
+        if not self.failures:
+            return self.interval
 
-            if not curr_song_title == channel["song_title"]:
-                song = await fetch_song_by_title(database, curr_song_title)
+        # exponential backoff with equal jitter, capped by the backoff interval
+        delay = min(self.backoff_interval, self.interval * 2 ** (self.failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
 
-                if not song:
-                    song_id = await insert_song(database, curr_song_title)
+    def conditional_headers(self) -> Dict:
+        headers = {}
+
+        if self.etag:
+            headers[hdrs.IF_NONE_MATCH] = self.etag
+
+        if self.last_modified:
+            headers[hdrs.IF_MODIFIED_SINCE] = self.last_modified
+
+        return headers
+
+    async def reconcile(self) -> None:
+        if self.reconciled_at is not None and time.monotonic() - self.reconciled_at < self.reconcile_interval:
+            return
+
+        channel = await fetch_channel_extra(self.database, self.channel["id"])
+        self.channel.update(song_id=channel["song_id"], song_title=channel["song_title"])
+        self.reconciled_at = time.monotonic()
+        self.log.debug(f"Reconciled channel_id={self.channel['id']} (song_title={self.channel['song_title']})")
+
+    async def poll(self) -> None:
+        started_at = time.perf_counter()
+
+        try:
+            _, response_status_code, response_body, response_headers = \
+                await fetch_channel_content_hedged(self.channel, self.session, self.conditional_headers())
+        finally:
+            self.latency.observe(time.perf_counter() - started_at)
+
+        self.last_status = response_status_code
+        content_hash = hashlib.sha1(response_body).hexdigest()
+
+        # upstream may ignore conditional requests, the content hash catches an unchanged body anyway
+        if response_status_code == HTTPStatus.NOT_MODIFIED \
+                or (response_status_code == HTTPStatus.OK and content_hash == self.content_hash):
+            self.unchanged_polls += 1
+            self.log.debug(f"Content not modified for channel_id={self.channel['id']}")
+            return
+
+        if not response_status_code == HTTPStatus.OK:
+            raise ChannelResponseError(f"status_code={response_status_code}")
+
+        await self.reconcile()
+        channel = self.channel
+        curr_song_title = extract(response_body.decode("utf8"))
+        history_item_id = 0
+
+        if not curr_song_title == channel["song_title"]:
+            song_id = self.songs_cache.get(curr_song_title, 0)
+            history_item = await self.writer.write(channel["id"], curr_song_title, song_id)
+            history_item_id = history_item["id"]
+            self.songs_cache.set(curr_song_title, history_item["song_id"])
+            self.channel.update(song_id=history_item["song_id"], song_title=curr_song_title)
+
+        # remember validators only once the content was processed, so a failed poll is retried in full
+        self.etag = response_headers.get(hdrs.ETAG)
+        self.last_modified = response_headers.get(hdrs.LAST_MODIFIED)
+        self.content_hash = content_hash
+
+        self.log.info(f"{('History updated' if history_item_id > 0 else 'No update')} "
+                      f"for channel_id={channel['id']}")
+
+    async def run(self, forever: bool = True) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            started_at = loop.time()
+
+            if self.circuit_breaker.allow(started_at):
+                self.polls += 1
+                self.last_poll_at = time.time()
+
+                try:
+                    await self.poll()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = repr(e)
+                    # the write may or may not have landed, read the last song again on the next poll
+                    self.reconciled_at = None
+                    self.circuit_breaker.record_failure(self.failures, started_at)
+                    self.log.warning(f"Cannot process channel_id={self.channel['id']} ({self.last_error}, "
+                                     f"failures={self.failures}, circuit={self.circuit_breaker.state})")
                 else:
-                    song_id = song["id"]
+                    self.failures = 0
+                    self.last_error = None
+                    self.circuit_breaker.record_success()
+
+            if not forever:
+                break
+
+            # keep a fixed rate on success instead of drifting by the poll duration
+            delay = max(0.0, self.next_delay() - (loop.time() - started_at))
+
+            if self.circuit_breaker.state == CircuitBreaker.OPEN:
+                delay = max(delay, self.circuit_breaker.timeout)
+
+            self.next_poll_at = time.time() + delay
+            await self.publish_state()
+            await asyncio.sleep(delay)
+
+        await self.publish_state()
+
+    async def publish_state(self) -> None:
+        try:
+            await self.redis.hset(settings["crawler"]["state_key"], self.channel["id"], json.dumps(self.state()))
+        except Exception:
+            self.log.debug("Cannot publish channel state", exc_info=True)
 
-                history_item_id = await insert_history_item(database, channel["id"], song_id)
-                history_item = await fetch_history_item(database, history_item_id)
-                redis.publish_json(settings["redis"]["channel"], history_item)
 
-            log.info(f"{('History updated' if history_item_id > 0 else 'No update')} for channel_id={channel['id']}")
+async def worker(forever: bool = True):
+    setup_logging()
+    log = logging.getLogger(__name__)
+
+    redis = await create_redis(settings["redis"]["url"])
+    database = Database(settings["postgres"]["url"])
+    await database.connect()
 
-        if not forever:
-            break
+    channels = await fetch_channels_extra(database)
+    # a single session for the worker lifetime keeps pooled connections and the DNS cache between polls
+    session = create_client_session(len(channels))
+    songs_cache = await create_songs_cache(database)
+    writer = HistoryWriter(database, redis)
+    writer.start()
+    partitions_task = asyncio.ensure_future(maintain_history_partitions(database, forever))
+    sharding = settings["crawler"]["sharding"]["enabled"]
 
-        await asyncio.sleep(sleep_interval)
+    def create_poller(channel: Dict) -> ChannelPoller:
+        # another worker may have written the channel history since startup
+        return ChannelPoller(channel, database, redis, session, songs_cache, writer, stale=sharding)
 
-    await database.disconnect()
-    redis.close()
+    try:
+        if sharding:
+            leases = LeaseManager(redis, generate_worker_id())
+            coordinator = LeaseCoordinator(leases, channels, create_poller)
+            log.info(f"Polling leased channels as worker_id={leases.worker_id}")
+            await coordinator.run(forever)
+        else:
+            pollers = [create_poller(channel) for channel in channels]
+            log.info(f"Polling channels {[poller.state() for poller in pollers]}")
+            await asyncio.gather(*[poller.run(forever) for poller in pollers])
+    finally:
+        log.debug(f"Songs cache {songs_cache.stats()}")
+        partitions_task.cancel()
+        await asyncio.gather(partitions_task, return_exceptions=True)
+        await writer.close()
+        await session.close()
+        await database.disconnect()
+        redis.close()
+        await redis.wait_closed()
 
 
 def main():
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from aioredis import Redis
+
+from api.settings import settings
+
+# only the lease owner may extend or drop it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def generate_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseManager:
+    """Channel leases stored in Redis with a TTL, so each channel has exactly one live owner"""
+
+    def __init__(self, redis: Redis, worker_id: str) -> None:
+        sharding_settings = settings["crawler"]["sharding"]
+
+        self.redis = redis
+        self.worker_id = worker_id
+        self.ttl = sharding_settings["lease_ttl"]
+        self.prefix = sharding_settings["prefix"]
+
+    def channel_key(self, channel_id: int) -> str:
+        return f"{self.prefix}:channel:{channel_id}"
+
+    @property
+    def workers_key(self) -> str:
+        return f"{self.prefix}:workers"
+
+    async def acquire(self, channel_id: int) -> bool:
+        acquired = await self.redis.set(self.channel_key(channel_id), self.worker_id,
+                                        pexpire=self.ttl, exist=Redis.SET_IF_NOT_EXIST)
+        return bool(acquired)
+
+    async def renew(self, channel_id: int) -> bool:
+        renewed = await self.redis.eval(RENEW_SCRIPT, keys=[self.channel_key(channel_id)],
+                                        args=[self.worker_id, self.ttl])
+        return bool(renewed)
+
+    async def release(self, channel_id: int) -> None:
+        await self.redis.eval(RELEASE_SCRIPT, keys=[self.channel_key(channel_id)], args=[self.worker_id])
+
+    async def heartbeat(self) -> int:
+        """Register this worker as alive and return the number of live workers"""
+        now = time.time()
+        await self.redis.zadd(self.workers_key, now, self.worker_id)
+        await self.redis.zremrangebyscore(self.workers_key, max=now - self.ttl / 1000)
+        return max(1, await self.redis.zcard(self.workers_key))
+
+    async def leave(self) -> None:
+        await self.redis.zrem(self.workers_key, self.worker_id)
+
+
+class LeaseCoordinator:
+    """Claim a fair share of the channels and run a poller only for the channels this worker leases
+
+    Leases are renewed every third of their TTL. A dead worker stops renewing, its leases expire and
+    the remaining workers pick up its channels. When a worker joins, the others release their surplus.
+    """
+
+    def __init__(self, leases: LeaseManager, channels: List[Dict], poller_factory: Callable) -> None:
+        self.leases = leases
+        self.channels = channels
+        self.poller_factory = poller_factory
+        self.pollers = {}
+        self.tasks = {}
+        self.log = logging.getLogger(__name__)
+
+    def state(self) -> Dict:
+        return {"worker_id": self.leases.worker_id, "channels": sorted(self.tasks.keys())}
+
+    async def start_poller(self, channel: Dict, forever: bool) -> None:
+        poller = self.poller_factory(channel)
+        self.pollers[channel["id"]] = poller
+        self.tasks[channel["id"]] = asyncio.ensure_future(poller.run(forever))
+        self.log.info(f"Leased channel_id={channel['id']} to worker_id={self.leases.worker_id}")
+
+    async def stop_poller(self, channel_id: int, release: bool = True) -> None:
+        task = self.tasks.pop(channel_id)
+        self.pollers.pop(channel_id)
+        task.cancel()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        if release:
+            await self.leases.release(channel_id)
+
+        self.log.info(f"Released channel_id={channel_id} by worker_id={self.leases.worker_id}")
+
+    async def rebalance(self, forever: bool) -> None:
+        workers = await self.leases.heartbeat()
+        fair_share = math.ceil(len(self.channels) / workers)
+
+        for channel_id in list(self.tasks.keys()):
+            # a lease lost to another worker must stop the local poller right away
+            if not await self.leases.renew(channel_id):
+                self.log.warning(f"Lost lease for channel_id={channel_id}")
+                await self.stop_poller(channel_id, release=False)
+
+        for channel_id in list(self.tasks.keys())[fair_share:]:
+            await self.stop_poller(channel_id)
+
+        for channel in self.channels:
+            if len(self.tasks) >= fair_share:
+                break
+
+            if channel["id"] not in self.tasks and await self.leases.acquire(channel["id"]):
+                await self.start_poller(channel, forever)
+
+    async def run(self, forever: bool = True) -> None:
+        try:
+            await self.rebalance(forever)
+
+            if not forever:
+                await asyncio.gather(*self.tasks.values())
+                return
+
+            while True:
+                await asyncio.sleep(self.leases.ttl / 3000)
+                await self.rebalance(forever)
+        finally:
+            for channel_id in list(self.tasks.keys()):
+                await self.stop_poller(channel_id)
+
+            await self.leases.leave()
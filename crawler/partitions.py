@@ -0,0 +1,49 @@
+import asyncio
+import logging
+
+from databases import Database
+
+from api.database import create_history_partitions
+from api.logger import setup_logging
+from api.settings import settings
+
+
+async def maintain_history_partitions(database: Database, forever: bool = True) -> None:
+    """Keep the monthly history partitions created ahead of time
+
+    Rows of a month without a partition land in the default partition, they are moved once it is created.
+    """
+    log = logging.getLogger(__name__)
+    partitions_settings = settings["crawler"]["partitions"]
+
+    while True:
+        try:
+            await create_history_partitions(database, partitions_settings["months_ahead"])
+            log.debug(f"History partitions created {partitions_settings['months_ahead']} months ahead")
+        except Exception:
+            log.exception("Cannot create history partitions")
+
+        if not forever:
+            break
+
+        await asyncio.sleep(partitions_settings["interval"])
+
+
+async def run() -> None:
+    setup_logging()
+    database = Database(settings["postgres"]["url"])
+    await database.connect()
+
+    try:
+        # errors are not swallowed here, a scheduled run has to fail visibly
+        await create_history_partitions(database, settings["crawler"]["partitions"]["months_ahead"])
+    finally:
+        await database.disconnect()
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from aioredis import Redis
+from databases import Database
+
+from api.database import insert_history_item_by_song_title, insert_history_items
+from api.redis import publish_history_items
+from api.settings import settings
+
+
+class HistoryWriter:
+    """Write stage between the channel pollers and the database / Redis
+
+    In "immediate" mode each change is written and published on its own, for the freshest events.
+    In "batch" mode the changes collected during the flush interval are committed together in one
+    transaction and then published through a single Redis pipeline, for throughput.
+
+    Nothing is published unless it was committed: when the transaction fails every pending write
+    fails with the same error and the pollers retry on their next poll.
+    """
+
+    def __init__(self, database: Database, redis: Redis) -> None:
+        writer_settings = settings["crawler"]["writer"]
+
+        self.database = database
+        self.redis = redis
+        self.mode = writer_settings["mode"]
+        self.flush_interval = writer_settings["flush_interval"]
+        self.max_batch_size = writer_settings["max_batch_size"]
+        self.pending: List[Tuple[Dict, asyncio.Future]] = []
+        self.flushed = asyncio.Event()
+        self.flusher = None
+        self.log = logging.getLogger(__name__)
+
+    def start(self) -> None:
+        if self.mode == "batch":
+            self.flusher = asyncio.ensure_future(self.run())
+
+    async def close(self) -> None:
+        if self.flusher is not None:
+            self.flusher.cancel()
+
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+
+        while self.pending:
+            await self.flush()
+
+    async def write(self, channel_id: int, song_title: str, song_id: int = 0) -> Dict:
+        if self.mode == "immediate":
+            history_item = await insert_history_item_by_song_title(self.database, channel_id, song_title, song_id)
+            await self.publish([history_item])
+            return history_item
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(({"channel_id": channel_id, "song_title": song_title, "song_id": song_id}, future))
+
+        if len(self.pending) >= self.max_batch_size:
+            self.flushed.set()
+
+        return await future
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.flushed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.flushed.clear()
+            await self.flush()
+
+            if len(self.pending) >= self.max_batch_size:
+                self.flushed.set()
+
+    async def flush(self) -> None:
+        batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+
+        if not batch:
+            return
+
+        items = [item for item, _ in batch]
+
+        try:
+            async with self.database.transaction():
+                history_items = await insert_history_items(self.database, items)
+        except Exception as e:
+            self.log.exception(f"Cannot commit {len(items)} history items")
+
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        await self.publish(history_items)
+
+        # a channel has a single pending write since its poller waits for it, RETURNING order is not guaranteed
+        history_items_by_channel = {history_item["channel_id"]: history_item for history_item in history_items}
+
+        for item, future in batch:
+            if future.done():
+                continue
+
+            if item["channel_id"] in history_items_by_channel:
+                future.set_result(history_items_by_channel[item["channel_id"]])
+            else:
+                future.set_exception(RuntimeError(f"History item of channel_id={item['channel_id']} not returned"))
+
+        self.log.debug(f"Committed and published {len(history_items)} history items")
+
+    async def publish(self, history_items: List[Dict]) -> None:
+        # committed rows stay committed, a failed publish is only logged
+        try:
+            await publish_history_items(self.redis, history_items)
+        except Exception:
+            self.log.exception(f"Cannot publish {len(history_items)} history items")
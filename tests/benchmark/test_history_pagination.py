@@ -0,0 +1,60 @@
+import os
+import time
+from statistics import median
+
+import pytest
+from databases import Database
+
+from api.database import fetch_history, insert_song
+from api.settings import settings
+
+pytestmark = pytest.mark.skipif(not os.environ.get("API_BENCHMARK"), reason="API_BENCHMARK is not set")
+
+ROWS = 500000
+DEPTHS = (1, 100, 1000, 5000)
+ROUNDS = 5
+
+
+async def measure(database: Database, parameters: dict) -> float:
+    timings = []
+
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        await fetch_history(database, parameters)
+        timings.append(time.perf_counter() - start)
+
+    return median(timings)
+
+
+async def test_history_pagination_depth():
+    limit = settings["pagination"]["limit"]
+    database = Database(settings["postgres"]["url"], force_rollback=True)
+    await database.connect()
+
+    try:
+        song_id = await insert_song(database, "benchmark")
+        await database.execute(query="INSERT INTO history (song_id, channel_id) "
+                                     "SELECT :song_id, 1 + (i % 3) FROM generate_series(1, :rows) AS i",
+                               values={"song_id": song_id, "rows": ROWS})
+        await database.execute(query="ANALYZE history")
+        # raw queries are only indexed by column name
+        max_id = await database.fetch_val(query="SELECT max(id) FROM history", column="max")
+
+        offset_timings = {}
+        cursor_timings = {}
+
+        for depth in DEPTHS:
+            offset_timings[depth] = await measure(database, {"channel_id": 0, "before_id": 0,
+                                                             "offset": depth * limit})
+            cursor_timings[depth] = await measure(database, {"channel_id": 0, "before_id": max_id - depth * limit,
+                                                             "offset": 0})
+
+        for depth in DEPTHS:
+            print(f"page={depth} offset={offset_timings[depth] * 1000:.2f}ms "
+                  f"cursor={cursor_timings[depth] * 1000:.2f}ms")
+    finally:
+        await database.disconnect()
+
+    # keyset pages cost the same at any depth, offset pages degrade linearly
+    assert cursor_timings[DEPTHS[-1]] < cursor_timings[DEPTHS[0]] * 3
+    assert cursor_timings[DEPTHS[-1]] < offset_timings[DEPTHS[-1]]
@@ -0,0 +1,32 @@
+import json
+import os
+import timeit
+from datetime import datetime
+
+import pytest
+
+from api.schemas import HistorySchema, dumps, history_dumper
+
+pytestmark = pytest.mark.skipif(not os.environ.get("API_BENCHMARK"), reason="API_BENCHMARK is not set")
+
+ROWS = 50
+ROUNDS = 2000
+
+
+def test_history_serialization():
+    rows = [{"id": i, "created_at": datetime(2019, 5, 1, 12, i % 60), "song_id": i, "song_title": f"song {i}",
+             "channel_id": 1 + i % 3} for i in range(ROWS)]
+
+    def marshmallow_dump():
+        return json.dumps(HistorySchema(many=True).dump(rows)).encode("utf-8")
+
+    def fast_dump():
+        return dumps(history_dumper.dump_many(rows))
+
+    marshmallow_timing = timeit.timeit(marshmallow_dump, number=ROUNDS) / ROUNDS
+    fast_timing = timeit.timeit(fast_dump, number=ROUNDS) / ROUNDS
+
+    print(f"rows={ROWS} marshmallow={marshmallow_timing * 1000:.3f}ms fast={fast_timing * 1000:.3f}ms")
+
+    assert fast_dump() == marshmallow_dump()
+    assert fast_timing < marshmallow_timing
@@ -0,0 +1,72 @@
+from typing import Tuple
+
+from databases import Database
+
+from api import database as queries
+from api.schemas import BookmarkSchema, HistorySchema
+from api.settings import settings
+
+HISTORY_KEYS = {name for name, field in HistorySchema().fields.items() if not field.load_only}
+BOOKMARK_KEYS = {name for name, field in BookmarkSchema().fields.items() if not field.load_only}
+
+
+async def insert_song_and_user(database: Database) -> Tuple[int, int]:
+    song_id = await queries.insert_song(database, "database song bookmarked")
+    user_id = await queries.insert_user(database, "database-user", "database", "user", "https://example.com/user.png")
+    return song_id, user_id
+
+
+async def test_insert_history_item_by_song_title():
+    database = Database(settings["postgres"]["url"], force_rollback=True)
+    await database.connect()
+
+    try:
+        channel_id = await database.fetch_val(query="SELECT min(id) AS id FROM channels", column="id")
+        history_item = await queries.insert_history_item_by_song_title(database, channel_id, "database song new")
+        known_history_item = await queries.insert_history_item_by_song_title(database, channel_id, "database song new",
+                                                                             history_item["song_id"])
+    finally:
+        await database.disconnect()
+
+    for item in (history_item, known_history_item):
+        assert set(item) == HISTORY_KEYS
+        assert item["channel_id"] == channel_id
+        assert item["song_title"] == "database song new"
+
+    assert known_history_item["id"] > history_item["id"]
+    assert known_history_item["song_id"] == history_item["song_id"]
+
+
+async def test_upsert_bookmark():
+    database = Database(settings["postgres"]["url"], force_rollback=True)
+    await database.connect()
+
+    try:
+        song_id, user_id = await insert_song_and_user(database)
+        bookmark = await queries.upsert_bookmark(database, user_id, song_id)
+        existing_bookmark = await queries.upsert_bookmark(database, user_id, song_id)
+        missing_song_bookmark = await queries.upsert_bookmark(database, user_id, song_id + 1000000)
+    finally:
+        await database.disconnect()
+
+    assert set(bookmark) == BOOKMARK_KEYS
+    assert bookmark["song_id"] == song_id
+    assert bookmark["user_id"] == user_id
+    assert bookmark["song_title"] == "database song bookmarked"
+    assert existing_bookmark == bookmark
+    assert missing_song_bookmark == {}
+
+
+async def test_upsert_bookmarks():
+    database = Database(settings["postgres"]["url"], force_rollback=True)
+    await database.connect()
+
+    try:
+        song_id, user_id = await insert_song_and_user(database)
+        bookmark = await queries.upsert_bookmark(database, user_id, song_id)
+        bookmarks = await queries.upsert_bookmarks(database, user_id, [song_id, song_id + 1000000])
+    finally:
+        await database.disconnect()
+
+    assert bookmarks == [bookmark]
+    assert set(bookmarks[0]) == BOOKMARK_KEYS
@@ -0,0 +1,182 @@
+import json
+from typing import Dict, Iterable, List
+
+from databases import Database
+from sqlalchemy.dialects import postgresql
+
+from api import database as queries
+from api.settings import settings
+
+SONGS = 20000
+HISTORY = 200000
+USERS = 1000
+BOOKMARKS = 50000
+LARGE_TABLES = {"songs", "history", "bookmarks"}
+# share of a sequential scan over history a single query may cost
+COST_BUDGET = 0.05
+# the songs cache prewarm runs once per crawler start and aggregates the latest history items
+COST_BUDGETS = {"fetch_songs_most_played": 0.25}
+
+
+class ExplainedDatabase:
+    """Explain every query before running it on the wrapped database"""
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.plans = []
+
+    async def explain(self, query, values: Dict = None) -> None:
+        if values:
+            query = query.values(**values)
+
+        sql = query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+        self.plans.append(await fetch_plan(self.database, sql))
+
+    def transaction(self):
+        return self.database.transaction()
+
+    async def fetch_all(self, query, values: Dict = None):
+        await self.explain(query, values)
+        return await self.database.fetch_all(query=query, values=values)
+
+    async def fetch_one(self, query, values: Dict = None):
+        await self.explain(query, values)
+        return await self.database.fetch_one(query=query, values=values)
+
+    async def fetch_val(self, query, values: Dict = None):
+        await self.explain(query, values)
+        return await self.database.fetch_val(query=query, values=values)
+
+    async def execute(self, query, values: Dict = None):
+        await self.explain(query, values)
+        return await self.database.execute(query=query, values=values)
+
+
+async def fetch_plan(database: Database, sql: str) -> Dict:
+    # raw queries are only indexed by column name
+    plan = await database.fetch_val(query=f"EXPLAIN (FORMAT JSON) {sql}", column="QUERY PLAN")
+    return json.loads(plan)[0]["Plan"]
+
+
+async def fetch_max(database: Database, sql: str, values: Dict = None) -> int:
+    return await database.fetch_val(query=sql, values=values, column="max")
+
+
+def walk(plan: Dict) -> Iterable[Dict]:
+    yield plan
+
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+
+def table_name(relation_name: str) -> str:
+    # history partitions are named history_y<year>m<month> and history_default
+    return "history" if relation_name.startswith("history_") else relation_name
+
+
+async def seed(database: Database) -> None:
+    # only the seeded rows are referenced, the database may already hold songs, users and bookmarks
+    await database.execute(query=f"INSERT INTO songs (title) SELECT 'plan song ' || i FROM generate_series(1, {SONGS}) AS i")
+    await database.execute(query=f"INSERT INTO history (song_id, channel_id) "
+                                 f"SELECT s.id, c.id FROM generate_series(1, {HISTORY}) AS i "
+                                 f"JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM songs "
+                                 f"WHERE title LIKE 'plan song %') s "
+                                 f"ON s.n = 1 + i % {SONGS} "
+                                 f"JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM channels) c "
+                                 f"ON c.n = 1 + i % (SELECT count(*) FROM channels)")
+    await database.execute(query=f"INSERT INTO users (sub, given_name, family_name, picture) "
+                                 f"SELECT lpad(i::text, 21, '0'), 'plan', 'user', NULL "
+                                 f"FROM generate_series(1, {USERS}) AS i")
+    await database.execute(query=f"INSERT INTO bookmarks (user_id, song_id) "
+                                 f"SELECT DISTINCT u.id, s.id FROM generate_series(1, {BOOKMARKS}) AS i "
+                                 f"JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM users "
+                                 f"WHERE given_name = 'plan') u "
+                                 f"ON u.n = 1 + i % {USERS} "
+                                 f"JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM songs "
+                                 f"WHERE title LIKE 'plan song %') s "
+                                 f"ON s.n = 1 + (i * 7) % {SONGS} "
+                                 f"ON CONFLICT DO NOTHING")
+
+    for table in LARGE_TABLES | {"users", "channels"}:
+        await database.execute(query=f"ANALYZE {table}")
+
+
+async def test_query_plans():
+    database = Database(settings["postgres"]["url"], force_rollback=True)
+    await database.connect()
+    failures: List[str] = []
+
+    try:
+        await seed(database)
+        explained = ExplainedDatabase(database)
+        scan_cost = (await fetch_plan(database, "SELECT * FROM history"))["Total Cost"]
+
+        channel_id = await database.fetch_val(query="SELECT min(id) FROM channels", column="min")
+        user_id = await fetch_max(database, "SELECT max(id) FROM users")
+        song_id = await fetch_max(database, "SELECT max(id) FROM songs")
+        history_id = await fetch_max(database, "SELECT max(id) FROM history")
+        bookmark_id = await fetch_max(database, "SELECT max(id) FROM bookmarks WHERE user_id = :user_id",
+                                      {"user_id": user_id})
+        sub = await database.fetch_val(query="SELECT sub FROM users WHERE id = :user_id", values={"user_id": user_id},
+                                       column="sub")
+        first_page = {"channel_id": 0, "before_id": 0, "offset": 0}
+        cursor_page = {"channel_id": channel_id, "before_id": history_id // 2, "offset": 0}
+        cursor_created_at = await database.fetch_val(query="SELECT created_at FROM history WHERE id = :history_id",
+                                                     values={"history_id": history_id // 2}, column="created_at")
+        bounded_cursor_page = dict(cursor_page, before_created_at=cursor_created_at)
+        created_at = await database.fetch_val(query="SELECT created_at FROM history WHERE id = :history_id",
+                                              values={"history_id": history_id}, column="created_at")
+
+        cases = {
+            "fetch_channels": lambda db: queries.fetch_channels(db),
+            "fetch_channels_extra": lambda db: queries.fetch_channels_extra(db),
+            "fetch_channel_extra": lambda db: queries.fetch_channel_extra(db, channel_id),
+            "fetch_song": lambda db: queries.fetch_song(db, song_id),
+            "fetch_song_by_title": lambda db: queries.fetch_song_by_title(db, "plan song 1"),
+            "fetch_songs_most_played": lambda db: queries.fetch_songs_most_played(db, 100, 1000),
+            "fetch_history": lambda db: queries.fetch_history(db, first_page),
+            "fetch_history_channel": lambda db: queries.fetch_history(
+                db, dict(first_page, channel_id=channel_id)),
+            "fetch_history_cursor": lambda db: queries.fetch_history(db, cursor_page),
+            "fetch_history_bounded_cursor": lambda db: queries.fetch_history(db, bounded_cursor_page),
+            "fetch_history_user": lambda db: queries.fetch_history(db, cursor_page, user_id),
+            "fetch_song_bookmark_ids": lambda db: queries.fetch_song_bookmark_ids(db, user_id, [song_id, 1, 2]),
+            "fetch_history_item": lambda db: queries.fetch_history_item(db, history_id),
+            "fetch_history_item_created_at": lambda db: queries.fetch_history_item(db, history_id, created_at),
+            "insert_history_item_by_song_title": lambda db: queries.insert_history_item_by_song_title(
+                db, channel_id, "plan song new"),
+            "insert_history_item_by_song_id": lambda db: queries.insert_history_item_by_song_title(
+                db, channel_id, "plan song 1", song_id),
+            "insert_history_items": lambda db: queries.insert_history_items(
+                db, [{"channel_id": channel_id, "song_title": "plan song batch", "song_id": 0},
+                     {"channel_id": channel_id, "song_title": "plan song 2", "song_id": song_id}]),
+            "fetch_user": lambda db: queries.fetch_user(db, user_id),
+            "fetch_user_by_sub": lambda db: queries.fetch_user_by_sub(db, sub),
+            "fetch_bookmarks": lambda db: queries.fetch_bookmarks(db, {"before_id": 0, "offset": 0}, user_id),
+            "fetch_bookmarks_cursor": lambda db: queries.fetch_bookmarks(db, {"before_id": bookmark_id, "offset": 0},
+                                                                         user_id),
+            "fetch_bookmark": lambda db: queries.fetch_bookmark(db, bookmark_id),
+            "fetch_bookmark_by_user_and_song": lambda db: queries.fetch_bookmark_by_user_and_song(db, user_id, song_id),
+            "upsert_bookmark": lambda db: queries.upsert_bookmark(db, user_id, song_id),
+            "upsert_bookmarks": lambda db: queries.upsert_bookmarks(db, user_id, [song_id, 1, 2]),
+            "delete_bookmarks": lambda db: queries.delete_bookmarks(db, user_id, [bookmark_id]),
+        }
+
+        for name, run in cases.items():
+            explained.plans = []
+            await run(explained)
+
+            for plan in explained.plans:
+                seq_scans = {table_name(node["Relation Name"]) for node in walk(plan) if node["Node Type"] == "Seq Scan"}
+
+                if seq_scans & LARGE_TABLES:
+                    failures.append(f"{name}: sequential scan on {', '.join(sorted(seq_scans & LARGE_TABLES))}")
+
+                budget = scan_cost * COST_BUDGETS.get(name, COST_BUDGET)
+
+                if plan["Total Cost"] > budget:
+                    failures.append(f"{name}: cost {plan['Total Cost']:.0f} over budget {budget:.0f}")
+    finally:
+        await database.disconnect()
+
+    assert not failures, "\n".join(failures)
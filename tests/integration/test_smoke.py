@@ -25,3 +25,60 @@ async def test_history(aiohttp_client):
 
     assert response.status == 200
     assert len(body) > 0
+
+
+async def test_history_cursor(aiohttp_client):
+    app = await build()
+
+    client = await aiohttp_client(app)
+
+    response = await client.get('/history')
+    body = await response.json()
+
+    cursor_response = await client.get('/history', params={"before_id": body[0]["id"]})
+    cursor_body = await cursor_response.json()
+
+    try:
+        await client.close()
+    except asyncio.CancelledError:
+        pass
+
+    assert cursor_response.status == 200
+    assert all(item["id"] < body[0]["id"] for item in cursor_body)
+
+
+async def test_now_playing(aiohttp_client):
+    app = await build()
+
+    client = await aiohttp_client(app)
+
+    response = await client.get('/now_playing')
+    body = await response.json()
+
+    try:
+        await client.close()
+    except asyncio.CancelledError:
+        pass
+
+    assert response.status == 200
+    assert len(body) > 0
+
+
+async def test_history_etag(aiohttp_client):
+    app = await build()
+
+    client = await aiohttp_client(app)
+
+    response = await client.get('/history')
+    etag = response.headers["ETag"]
+
+    conditional_response = await client.get('/history', headers={"If-None-Match": etag})
+
+    try:
+        await client.close()
+    except asyncio.CancelledError:
+        pass
+
+    assert response.status == 200
+    assert conditional_response.status == 304
+    assert conditional_response.headers["ETag"] == etag
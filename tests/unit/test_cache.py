@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+from api import cache as cache_module
+from api.cache import HistoryCache, LRUCache, fetch_history_cached
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("b", 0) == 0
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 2, "misses": 1}
+
+
+def test_history_cache():
+    cache = HistoryCache(4, 60)
+    parameters = {"offset": 0, "before_id": 0, "channel_id": 0}
+    version = cache.version(0)
+    cache.set(parameters, [{"id": 1, "channel_id": 1, "song_id": 1, "bookmark_id": 0}], version)
+    cache.add_history_item({"id": 2, "channel_id": 1, "song_id": 2})
+
+    assert [item["id"] for item in cache.get(parameters)] == [2, 1]
+
+    cache.add_history_item({"id": 2, "channel_id": 1, "song_id": 2})
+
+    assert cache.get(parameters) is None
+
+    cache.set(parameters, [], version)
+
+    assert cache.get(parameters) is None
+
+
+def test_history_cache_clear_and_max_age(monkeypatch):
+    cache = HistoryCache(4, 60)
+    parameters = {"offset": 0, "before_id": 0, "channel_id": 0}
+    page = [{"id": 1, "channel_id": 1, "song_id": 1, "bookmark_id": 0}]
+    version = cache.version(0)
+    cache.clear()
+    cache.set(parameters, page, version)
+
+    assert cache.get(parameters) is None
+
+    cache.set(parameters, page, cache.version(0))
+
+    assert cache.get(parameters) == page
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+
+    assert cache.get(parameters) is None
+
+
+def test_fetch_history_cached_bookmarks(monkeypatch):
+    fetched = []
+
+    async def fetch_history(database, parameters, user_id=0):
+        fetched.append(user_id)
+        return [{"id": 2, "channel_id": 1, "song_id": 5, "bookmark_id": 0},
+                {"id": 1, "channel_id": 1, "song_id": 6, "bookmark_id": 0}]
+
+    async def fetch_song_bookmark_ids(database, user_id, song_ids):
+        return {6: 9}
+
+    monkeypatch.setattr(cache_module, "fetch_history", fetch_history)
+    monkeypatch.setattr(cache_module, "fetch_song_bookmark_ids", fetch_song_bookmark_ids)
+    app = {"database": None, "history_cache": HistoryCache(4, 60), "history_events_live": True}
+    parameters = {"offset": 0, "before_id": 0, "channel_id": 0}
+    anonymous_page = asyncio.run(fetch_history_cached(app, parameters))
+    user_page = asyncio.run(fetch_history_cached(app, parameters, 3))
+
+    assert fetched == [0]
+    assert [item["bookmark_id"] for item in anonymous_page] == [0, 0]
+    assert [item["bookmark_id"] for item in user_page] == [0, 9]
+    assert app["history_cache"].get(parameters) == anonymous_page
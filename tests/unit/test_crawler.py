@@ -0,0 +1,56 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from crawler import writer as writer_module
+from crawler.crawler import CircuitBreaker
+from crawler.writer import HistoryWriter
+
+
+def test_circuit_breaker():
+    circuit_breaker = CircuitBreaker(threshold=2, timeout=10)
+
+    circuit_breaker.record_failure(1, 0)
+    assert circuit_breaker.allow(0)
+
+    circuit_breaker.record_failure(2, 0)
+    assert not circuit_breaker.allow(5)
+    assert circuit_breaker.allow(10)
+    assert circuit_breaker.state == CircuitBreaker.HALF_OPEN
+
+    circuit_breaker.record_failure(3, 10)
+    assert not circuit_breaker.allow(15)
+
+    assert circuit_breaker.allow(20)
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+class FakeDatabase:
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+def test_history_writer_close(monkeypatch):
+    async def insert_history_items(database, items):
+        # RETURNING order is not guaranteed
+        return [{"id": i, "channel_id": item["channel_id"]} for i, item in reversed(list(enumerate(items)))]
+
+    async def publish_history_items(redis, history_items):
+        pass
+
+    monkeypatch.setattr(writer_module, "insert_history_items", insert_history_items)
+    monkeypatch.setattr(writer_module, "publish_history_items", publish_history_items)
+
+    async def run():
+        writer = HistoryWriter(FakeDatabase(), None)
+        writer.mode = "batch"
+        writer.max_batch_size = 2
+        writes = [asyncio.ensure_future(writer.write(channel_id, "song")) for channel_id in range(1, 6)]
+        await asyncio.sleep(0)
+        await writer.close()
+        return await asyncio.gather(*writes)
+
+    history_items = asyncio.run(run())
+
+    assert [history_item["channel_id"] for history_item in history_items] == [1, 2, 3, 4, 5]
@@ -0,0 +1,44 @@
+import asyncio
+
+from api import metrics
+from api.database import coalesce
+
+
+def test_coalesce():
+    calls = []
+
+    @coalesce
+    async def fetch(database, parameters):
+        calls.append(parameters)
+        await asyncio.sleep(0.01)
+        return [parameters]
+
+    async def fetch_concurrently():
+        return await asyncio.gather(*[fetch(None, {"channel_id": 1}) for _ in range(3)], fetch(None, {"channel_id": 2}))
+
+    coalesced_reads = metrics.snapshot().get("database_coalesced_reads", 0)
+    results = asyncio.run(fetch_concurrently())
+
+    assert calls == [{"channel_id": 1}, {"channel_id": 2}]
+    assert results[0] is results[1] is results[2]
+    assert metrics.snapshot()["database_coalesced_reads"] == coalesced_reads + 2
+
+
+def test_coalesce_cancelled_callers():
+    errors = []
+
+    @coalesce
+    async def fetch(database, parameters):
+        await asyncio.sleep(0.01)
+        raise ValueError(parameters)
+
+    async def cancel_callers():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        caller = asyncio.ensure_future(fetch(None, {"channel_id": 1}))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0.02)
+
+    asyncio.run(cancel_callers())
+
+    assert errors == []
@@ -0,0 +1,31 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+from api.schemas import (BookmarkSchema, HistoryRequestQuerySchema, HistorySchema, bookmark_dumper, dumps,
+                         encode_cursor, history_dumper)
+
+
+def test_history_dumper():
+    rows = [
+        {"id": 2, "created_at": datetime(2019, 5, 1, 12, 30, 15, 123456), "song_id": 3, "song_title": "Ünïcode",
+         "channel_id": 1},
+        {"id": 1, "created_at": datetime(2019, 5, 1, 14, 0, tzinfo=timezone(timedelta(hours=2))), "song_id": None,
+         "song_title": None, "channel_id": 1, "bookmark_id": 7},
+    ]
+
+    assert dumps(history_dumper.dump_many(rows)) == json.dumps(HistorySchema(many=True).dump(rows)).encode("utf-8")
+
+
+def test_bookmark_dumper():
+    rows = [{"id": 1, "created_at": datetime(2019, 5, 1), "song_id": 3, "song_title": "title", "user_id": 4}]
+
+    assert dumps(bookmark_dumper.dump_many(rows)) == json.dumps(BookmarkSchema(many=True).dump(rows)).encode("utf-8")
+
+
+def test_history_cursor():
+    schema = HistoryRequestQuerySchema()
+    created_at = datetime(2019, 5, 1, 12, 30, 15)
+
+    assert schema.load({"cursor": encode_cursor(7)}) == {"before_id": 7, "offset": 0, "channel_id": 0}
+    assert schema.load({"cursor": encode_cursor(7, created_at.replace(tzinfo=timezone.utc))}) == {
+        "before_id": 7, "before_created_at": created_at, "offset": 0, "channel_id": 0}
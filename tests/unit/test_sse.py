@@ -0,0 +1,50 @@
+import asyncio
+
+from aiohttp_sse import EventSourceResponse
+
+from api.settings import settings
+from api.sse import encode_sse_frame, replay_history_events
+
+
+class BufferedEventSourceResponse(EventSourceResponse):
+    async def write(self, data: bytes) -> None:
+        self.buffer = data
+
+
+def test_encode_sse_frame():
+    response = BufferedEventSourceResponse()
+    asyncio.run(response.send('{"id": 1}', id=1, event="history", retry=30))
+
+    assert encode_sse_frame('{"id": 1}', id=1, event="history", retry=30) == response.buffer
+
+
+class FakeRedis:
+    def __init__(self, event_ids):
+        self.entries = [(f"{event_id}-0".encode(), {b"id": str(event_id).encode(), b"channel_id": b"1",
+                                                    b"data": f'{{"id": {event_id}}}'.encode()})
+                        for event_id in event_ids]
+
+    async def xrevrange(self, stream, start="+", stop="-", count=None):
+        entries = [entry for entry in reversed(self.entries) if start == "+" or entry[0] <= start]
+        return entries[:count]
+
+
+class ReplayedStream:
+    channel_ids = (0,)
+
+    async def replay(self, frames, last_event_id):
+        self.frames = frames
+
+
+def test_replay_history_events(monkeypatch):
+    monkeypatch.setitem(settings["redis"], "stream_batch_size", 2)
+    app = {"redis": FakeRedis(range(3, 9))}
+    stream = ReplayedStream()
+    asyncio.run(replay_history_events(app, stream, 4))
+
+    assert [event_id for event_id, _ in stream.frames] == [5, 6, 7, 8]
+
+    asyncio.run(replay_history_events(app, stream, 1))
+
+    assert [frame for _, frame in stream.frames] == [
+        encode_sse_frame('{"last_event_id": 1}', event="reset", retry=settings["sse"]["retry"])]